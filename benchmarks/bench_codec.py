@@ -0,0 +1,52 @@
+""" Compares the size and speed of the msgpack format (serialize.py) and the
+schema based codec (codec.py), on the messages of a committee. Run with:
+
+    python benchmarks/bench_codec.py [N] [items per block] [item size]
+"""
+
+import sys
+import timeit
+
+sys.path = [".", ".."] + sys.path
+
+from dlsconsensus import dls_net_peer, BLSACCEPTABLE, BLSLOCK, BLSACK
+from dlsconsensus.serialize import pack, unpack
+from dlsconsensus.codec import encode, decode
+
+
+def build_messages(N, items, size):
+    addrs = [ "peer%s" % i for i in range(N) ]
+    peers = [ dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=addrs, channel_id="Shard0")
+              for i in range(N) ]
+    quorum = N - peers[0].sm.faulty()
+
+    block = tuple("%s-%s" % (i, "x" * size) for i in range(items))
+    acceptables = [ p.pack_and_sign(BLSACCEPTABLE("Shard0", "BLSACCEPTABLE", p.my_addr(), 7, 3,
+                                                  (block, ), None)) for p in peers[:quorum] ]
+    lock = peers[0].pack_and_sign(BLSLOCK("Shard0", "BLSLOCK", peers[0].my_addr(), 7, 3, block,
+                                          tuple(sorted(acceptables)), None))
+    ack = peers[1].pack_and_sign(BLSACK("Shard0", "BLSACK", peers[1].my_addr(), 7, 3, block, None))
+    return [ ("BLSACCEPTABLE", acceptables[0]), ("BLSLOCK", lock), ("BLSACK", ack) ]
+
+
+def bench(fn, arg):
+    timer = timeit.Timer(lambda: fn(arg))
+    loops, _ = timer.autorange()
+    return min(timer.repeat(3, loops)) / loops * 1e9
+
+
+def main(N=16, items=10, size=32):
+    print("N=%s, %s items of %s bytes per block" % (N, items, size))
+    print("%-14s %10s %10s %12s %12s %12s %12s" % ("message", "msgpack B", "codec B",
+          "pack ns", "encode ns", "unpack ns", "decode ns"))
+
+    for name, msg in build_messages(N, items, size):
+        old, new = pack(msg), encode(msg)
+        assert unpack(old) == msg and decode(new) == msg
+
+        print("%-14s %10d %10d %12.0f %12.0f %12.0f %12.0f" % (name, len(old), len(new),
+              bench(pack, msg), bench(encode, msg), bench(unpack, old), bench(decode, new)))
+
+
+if __name__ == "__main__":
+    main(*[ int(a) for a in sys.argv[1:] ])
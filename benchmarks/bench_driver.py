@@ -0,0 +1,51 @@
+""" Runs a committee of peers over localhost TCP, each with an asyncio driver,
+and reports the throughput and latencies. Run with:
+
+    python benchmarks/bench_driver.py [N] [seconds] [round ms] [items per second] [adaptive] [pipeline]
+"""
+
+import sys
+import asyncio
+
+sys.path = [".", ".."] + sys.path
+
+from dlsconsensus import dls_net_peer
+from dlsconsensus.driver import dls_driver, dls_pacemaker, dls_adaptive_pacemaker
+
+
+async def run(N, seconds, round_ms, rate, adaptive, pipeline):
+    addrs = [ "peer%s" % i for i in range(N) ]
+    endpoints = {}
+    pacemaker = dls_adaptive_pacemaker if adaptive else dls_pacemaker
+    drivers = [ dls_driver(dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=addrs,
+                                        channel_id="Shard0", pipeline=pipeline or None),
+                           endpoints, pacemaker(round_ms / 1000.0)) for i in range(N) ]
+    for d in drivers:
+        await d.start(("127.0.0.1", 0))
+
+    ticks = int(seconds * 100)
+    for t in range(ticks):
+        for i in range(rate // 100):
+            drivers[(t + i) % N].submit("item-%s-%s" % (t, i))
+        await asyncio.sleep(0.01)
+
+    for d in drivers:
+        await d.stop()
+    return [ d.stats() for d in drivers ]
+
+
+def main(N=4, seconds=5, round_ms=10, rate=1000, adaptive=0, pipeline=0):
+    stats = asyncio.run(run(N, seconds, round_ms, rate, adaptive, pipeline))
+    print("N=%s, %s s, rounds of %s ms%s, %s items/s submitted%s" % (N, seconds, round_ms,
+          " (adaptive)" if adaptive else "", rate, 
+          ", pipeline of %s" % pipeline if pipeline else ""))
+    print("%-6s %8s %8s %10s %12s %14s %14s" % ("peer", "rounds", "blocks", "committed",
+          "items/s", "block lat ms", "commit lat ms"))
+    for i, s in enumerate(stats):
+        ms = lambda x: x * 1000 if x is not None else float("nan")
+        print("%-6s %8d %8d %10d %12.0f %14.1f %14.1f" % (i, s["rounds"], s["blocks"],
+              s["committed"], s["throughput"], ms(s["block_latency"]), ms(s["commit_latency"])))
+
+
+if __name__ == "__main__":
+    main(*[ int(a) for a in sys.argv[1:] ])
@@ -0,0 +1,69 @@
+""" Runs a committee of 4 hosts over Unix sockets, each running many shards in
+one or more worker processes, and reports the throughput. Run with:
+
+    python benchmarks/bench_host.py [shards] [workers per host] [seconds] [round ms] [items per second per shard]
+"""
+
+import sys
+import asyncio
+import tempfile
+import functools
+import multiprocessing
+
+sys.path = [".", ".."] + sys.path
+
+from dlsconsensus import dls_net_peer
+from dlsconsensus.driver import dls_pacemaker
+from dlsconsensus.host import dls_shard_host, shard_of, spawn_workers
+
+ADDRS = [ "A", "B", "C", "D" ]
+
+
+async def run(i, worker, endpoints, channels, workers, seconds, round_ms, rate):
+    host = dls_shard_host(endpoints, workers=workers, worker=worker)
+    for c in channels:
+        if shard_of(c, workers) == worker:
+            peer = dls_net_peer(my_id=i, priv="priv", addrs=ADDRS, pubs=ADDRS, channel_id=c)
+            host.add_peer(peer, dls_pacemaker(round_ms / 1000.0))
+    await host.start(endpoints[ADDRS[i]][worker])
+
+    ticks = int(seconds * 10)
+    for t in range(ticks):
+        for s in host.shards.values():
+            for j in range(rate // 10):
+                s.peer.put_sequence("item-%s-%s-%s" % (ADDRS[i], t, j))
+        await asyncio.sleep(0.1)
+
+    await host.stop()
+    return host.stats()
+
+
+def run_worker(i, endpoints, channels, workers, seconds, round_ms, rate, results, worker):
+    stats = asyncio.run(run(i, worker, endpoints, channels, workers, seconds, round_ms, rate))
+    results.put((ADDRS[i], worker, stats))
+
+
+def main(shards=8, workers=2, seconds=5, round_ms=20, rate=100):
+    channels = [ "Shard%s" % c for c in range(shards) ]
+    results = multiprocessing.get_context("spawn").Queue()
+    with tempfile.TemporaryDirectory() as tmp:
+        endpoints = { a: [ "%s/%s-%s.sock" % (tmp, a, w) for w in range(workers) ] for a in ADDRS }
+        procs = []
+        for i in range(len(ADDRS)):
+            procs += spawn_workers(functools.partial(run_worker, i, endpoints, channels, workers,
+                                                     seconds, round_ms, rate, results), workers)
+        stats = [ results.get() for _ in procs ]
+        for p in procs:
+            p.join()
+
+    print("%s shards on %s hosts of %s workers, %s s, rounds of %s ms, %s items/s per shard" % (
+          shards, len(ADDRS), workers, seconds, round_ms, rate))
+    print("%-6s %6s %7s %8s %8s %10s %12s" % ("host", "worker", "shards", "rounds", "blocks",
+          "committed", "items/s"))
+    for addr, worker, s in sorted(stats, key=lambda x: x[:2]):
+        print("%-6s %6d %7d %8d %8d %10d %12.0f" % (addr, worker, s["shards"], s["rounds"],
+              s["blocks"], s["committed"], s["throughput"]))
+
+
+if __name__ == "__main__":
+    main(*[ int(a) for a in sys.argv[1:] ])
@@ -1,4 +1,4 @@
 from .statemachine import dls_state_machine
 from .net import dls_net_peer
 from .serialize import pack, unpack        
-from .types import PHASE0, PHASE1LOCK, PHASE2ACK, RELEASE3, BLSDECISION, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSASK, BLSPUT
\ No newline at end of file
+from .types import PHASE0, PHASE1LOCK, PHASE2ACK, RELEASE3, BLSDECISION, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSASK, BLSPUT, BLSFETCH, BLSPAYLOAD, BLSHEALTH, BLSBUSY, BLSSUBSCRIBE, BLSBLOCKS
\ No newline at end of file
@@ -0,0 +1,279 @@
+""" A durable log of decided blocks. Each block is appended, with its BLSDECISION
+certificate, to a segment file, and a fixed size entry in an index file maps
+the block number to its segment and offset. The index is memory mapped, so
+opening a store does not depend on the number of blocks it holds. Writes go
+through a durability policy (see persist.py), and a record is synced before
+its index entry is written.
+
+Next to it, the item index maps each committed item to its block and position,
+in a hash table that is also memory mapped, and holds the length of the
+sequence after each block. """
+
+import os
+import mmap
+import struct
+from hashlib import sha256
+
+from .serialize import pack, unpack
+from .persist import dls_durability
+
+# Index entries: segment number, offset and length of the record.
+INDEX_ENTRY = struct.Struct(">IQI")
+
+# Item index entries: digest of the item, block number plus one, and position in the
+# block. Empty slots are all zeros.
+ITEM_ENTRY = struct.Struct(">16sII")
+
+# The length of the sequence after each block.
+END_ENTRY = struct.Struct(">Q")
+
+
+def sync_dir(path):
+    """ Makes the entries of a directory, as after a rename, durable. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def item_key(item):
+    return sha256(pack(item)).digest()[:16]
+
+
+class dls_item_index():
+    """ Where each committed item is, as (bno, position in the block). Items are kept by 
+    a 128 bit digest, in an open addressing hash table, which is rebuilt twice as large
+    once half full. Blocks are indexed after they are stored, so a block missing at
+    open is indexed again by the sequence. """
+
+    CAPACITY = 1024
+
+    def __init__(self, path, blocks, durability=None):
+        self.path = path
+        self.items_path = os.path.join(path, "items")
+        self.durability = durability if durability is not None else dls_durability()
+
+        # Drop any torn entry, or one past the blocks of the store.
+        ends_path = os.path.join(path, "ends")
+        self.ends_f = open(ends_path, "a+b")
+        size = os.path.getsize(ends_path)
+        self.blocks = min(blocks, size // END_ENTRY.size)
+        if size != self.blocks * END_ENTRY.size:
+            self.ends_f.truncate(self.blocks * END_ENTRY.size)
+
+        self.ends_map = None
+        self.mapped = 0
+        self.length = self.start(self.blocks)
+
+        if not os.path.exists(self.items_path):
+            self.create(self.items_path, self.CAPACITY)
+        self.items_f, self.table = self.open_table(self.items_path)
+        self.capacity = len(self.table) // ITEM_ENTRY.size
+
+    @staticmethod
+    def create(path, capacity):
+        with open(path, "wb") as f1:
+            f1.truncate(capacity * ITEM_ENTRY.size)
+
+    @staticmethod
+    def open_table(path):
+        f1 = open(path, "r+b")
+        return f1, mmap.mmap(f1.fileno(), 0)
+
+    @staticmethod
+    def probe(table, capacity, key):
+        """ Returns the slot of a key, or the empty slot where it goes, and its entry. """
+        i = int.from_bytes(key[:8], "big") & (capacity - 1)
+        while True:
+            entry = ITEM_ENTRY.unpack_from(table, i * ITEM_ENTRY.size)
+            if entry[1] == 0 or entry[0] == key:
+                return i, entry
+            i = (i + 1) & (capacity - 1)
+
+    def start(self, bno):
+        """ Returns the offset in the sequence of the first item of block bno. """
+        if bno == 0:
+            return 0
+        if bno > self.mapped:
+            self.ends_f.flush()
+            if self.ends_map is not None:
+                self.ends_map.close()
+            self.ends_map = mmap.mmap(self.ends_f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped = len(self.ends_map) // END_ENTRY.size
+        return END_ENTRY.unpack_from(self.ends_map, (bno - 1) * END_ENTRY.size)[0]
+
+    def get(self, item, default=None):
+        _, (_, bno1, pos) = self.probe(self.table, self.capacity, item_key(item))
+        # Entries of blocks past the indexed ones are left over from a crash.
+        return (bno1 - 1, pos) if 0 < bno1 <= self.blocks else default
+
+    def __contains__(self, item):
+        return self.get(item) is not None
+
+    def add(self, bno, items):
+        """ Indexes block bno, with the (position, item) pairs of its items that are new
+        in the sequence. """
+        if bno != self.blocks:
+            raise Exception("Wrong block number, next is %s" % self.blocks)
+
+        if 2 * (self.length + len(items)) > self.capacity:
+            self.grow(self.length + len(items))
+        for pos, item in items:
+            key = item_key(item)
+            i, _ = self.probe(self.table, self.capacity, key)
+            ITEM_ENTRY.pack_into(self.table, i * ITEM_ENTRY.size, key, bno + 1, pos)
+
+        # The end entry is written last, so a block is only indexed once complete.
+        if self.durability.fsync:
+            self.table.flush()
+        self.length += len(items)
+        entry = END_ENTRY.pack(self.length)
+        self.durability.write([ self.ends_f ], lambda f1: f1.write(entry))
+        self.blocks += 1
+
+    def grow(self, count):
+        """ Rebuilds the table with room for 'count' items, and replaces the old one once
+        complete. """
+        capacity = self.capacity
+        while 2 * count > capacity:
+            capacity *= 2
+
+        path = self.items_path + ".new"
+        self.create(path, capacity)
+        f1, table = self.open_table(path)
+        for i in range(self.capacity):
+            key, bno1, pos = ITEM_ENTRY.unpack_from(self.table, i * ITEM_ENTRY.size)
+            if 0 < bno1 <= self.blocks:
+                j, _ = self.probe(table, capacity, key)
+                ITEM_ENTRY.pack_into(table, j * ITEM_ENTRY.size, key, bno1, pos)
+        table.flush()
+
+        self.close_table()
+        os.replace(path, self.items_path)
+        if self.durability.fsync:
+            sync_dir(self.path)
+        self.items_f, self.table, self.capacity = f1, table, capacity
+
+    def close_table(self):
+        self.table.flush()
+        self.table.close()
+        self.items_f.close()
+
+    def close(self):
+        self.close_table()
+        self.ends_f.flush()
+        if self.ends_map is not None:
+            self.ends_map.close()
+        self.ends_f.close()
+
+
+class dls_block_store():
+    """ An append-only store of decided blocks, indexed by block number. """
+
+    SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, segment_size=None, durability=None):
+        self.path = path
+        self.segment_size = segment_size if segment_size is not None else self.SEGMENT_SIZE
+        # Decides when appended blocks are made durable. A peer sharing its policy with
+        # the store syncs the store before it releases messages.
+        self.durability = durability if durability is not None else dls_durability()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # Drop any torn entry at the end of the index.
+        index_path = os.path.join(path, "index")
+        self.index_f = open(index_path, "a+b")
+        size = os.path.getsize(index_path)
+        self.count = size // INDEX_ENTRY.size
+        if size != self.count * INDEX_ENTRY.size:
+            self.index_f.truncate(self.count * INDEX_ENTRY.size)
+
+        self.index_map = None
+        self.mapped = 0
+        self.segments = {}
+
+        # Appends continue after the last indexed record.
+        if self.count > 0:
+            segment, offset, length = self.entry(self.count - 1)
+            self.segment, self.offset = segment, offset + length
+        else:
+            self.segment, self.offset = 0, 0
+
+        f1 = self.segment_f(self.segment)
+        f1.truncate(self.offset)
+
+        self.items = dls_item_index(path, self.count, self.durability)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, bno):
+        return 0 <= bno < self.count
+
+    def segment_f(self, segment):
+        if segment not in self.segments:
+            name = os.path.join(self.path, "segment-%08d.log" % segment)
+            mode = "r+b" if os.path.exists(name) else "w+b"
+            self.segments[segment] = open(name, mode)
+        return self.segments[segment]
+
+    def entry(self, bno):
+        """ Returns the (segment, offset, length) of a block. """
+        if bno >= self.mapped:
+            self.remap()
+        return INDEX_ENTRY.unpack_from(self.index_map, bno * INDEX_ENTRY.size)
+
+    def remap(self):
+        self.index_f.flush()
+        if self.index_map is not None:
+            self.index_map.close()
+        self.index_map = mmap.mmap(self.index_f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mapped = len(self.index_map) // INDEX_ENTRY.size
+
+    def append(self, bno, block, decisions):
+        """ Appends the next decided block, and its certificate. """
+        if bno != self.count:
+            raise Exception("Wrong block number, next is %s" % self.count)
+
+        record = pack((bno, block, tuple(decisions)))
+        if self.offset > 0 and self.offset + len(record) > self.segment_size:
+            self.segment, self.offset = self.segment + 1, 0
+
+        def write_record(f1):
+            f1.seek(self.offset)
+            f1.write(record)
+        self.durability.write([ self.segment_f(self.segment) ], write_record)
+
+        # The index entry is written last, so a block is only visible once complete, 
+        # and only once its record is durable.
+        self.durability.sync()
+        entry = INDEX_ENTRY.pack(self.segment, self.offset, len(record))
+        self.durability.write([ self.index_f ], lambda f1: f1.write(entry))
+
+        self.offset += len(record)
+        self.count += 1
+
+    def get(self, bno):
+        """ Returns the block and the decisions certifying it. """
+        if bno not in self:
+            raise KeyError(bno)
+
+        segment, offset, length = self.entry(bno)
+        f1 = self.segment_f(segment)
+        f1.seek(offset)
+        _, block, decisions = unpack(f1.read(length))
+        return block, decisions
+
+    def get_block(self, bno):
+        return self.get(bno)[0]
+
+    def close(self):
+        self.durability.sync()
+        self.items.close()
+        if self.index_map is not None:
+            self.index_map.close()
+        self.index_f.close()
+        for f1 in self.segments.values():
+            f1.close()
@@ -0,0 +1,100 @@
+""" The inbound buffer of the state machine. Messages are indexed by phase and
+type, and the votes they carry are tallied as they arrive, so that the round
+handlers only look at the messages they need. """
+
+from functools import partial
+
+from .types import PHASE0, PHASE2ACK
+from .quorum import dls_tally
+
+
+class dls_buffer():
+    """ A set of state machine messages, indexed by (phase, type). """
+
+    def __init__(self, msgs=(), threshold=None, on_quorum=None):
+        self.phases = {}   # phase -> type -> set of messages
+        self.size = 0
+
+        # Votes are tallied for the messages that carry them.
+        self.tallies = {}
+        for mtype in (PHASE0, PHASE2ACK):
+            name = mtype.__name__
+            hook = partial(on_quorum, name) if on_quorum is not None else None
+            self.tallies[name] = dls_tally(threshold, hook)
+
+        self.update(msgs)
+
+    def set_threshold(self, threshold):
+        for tally in self.tallies.values():
+            tally.threshold = threshold
+
+    @staticmethod
+    def votes_of(msg):
+        """ Returns the items a message votes for. """
+        if type(msg) == PHASE0:
+            return msg.acceptable
+        elif type(msg) == PHASE2ACK:
+            return (msg.item, )
+        return ()
+
+    def add(self, msg):
+        """ Adds a message, and returns whether it was new. """
+        by_type = self.phases.setdefault(msg.phase, {})
+        msgs = by_type.setdefault(msg.type, set())
+        if msg in msgs:
+            return False
+
+        msgs.add(msg)
+        self.size += 1
+
+        items = self.votes_of(msg)
+        if len(items) > 0:
+            tally = self.tallies[type(msg).__name__]
+            for item in items:
+                tally.vote(msg.phase, item, msg.sender, msg)
+
+        return True
+
+    def update(self, msgs):
+        for msg in msgs:
+            self.add(msg)
+
+    def __ior__(self, msgs):
+        self.update(msgs)
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for by_type in self.phases.values():
+            for msgs in by_type.values():
+                for msg in msgs:
+                    yield msg
+
+    def __contains__(self, msg):
+        return msg in self.get(msg.type, msg.phase)
+
+    def get(self, mtype, phase):
+        """ Returns the messages of a type for a phase. """
+        return self.phases.get(phase, {}).get(mtype, frozenset())
+
+    def of_type(self, mtype):
+        """ Iterates over the messages of a type, for all phases. """
+        for by_type in self.phases.values():
+            for msg in by_type.get(mtype, ()):
+                yield msg
+
+    def tally(self, mtype):
+        """ Returns the vote tally for PHASE0 or PHASE2ACK messages. """
+        return self.tallies[mtype]
+
+    def drop_before(self, phase):
+        """ Drops all messages for phases before the one given. """
+        for old in [p for p in self.phases if p < phase]:
+            for msgs in self.phases[old].values():
+                self.size -= len(msgs)
+            del self.phases[old]
+
+        for tally in self.tallies.values():
+            tally.drop_before(phase)
@@ -0,0 +1,92 @@
+""" Small bounded caches with hit and miss counters. """
+
+from collections import OrderedDict
+
+from .serialize import pack
+from .codec import encode, encode_signed, signed_bytes
+
+
+class dls_lru():
+    """ A least recently used cache, of at most 'size' entries. """
+
+    def __init__(self, size=1024):
+        assert size > 0
+        self.size = size
+        self.data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Returns the cached value, and counts a hit or a miss. """
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """ Removes an entry, and returns its value, without counting a hit. """
+        return self.data.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def items(self):
+        """ Returns the entries, from the least recently used, without counting hits. """
+        return list(self.data.items())
+
+    def stats(self):
+        return { "hits": self.hits, "misses": self.misses, "size": len(self.data) }
+
+
+class dls_encoding_cache():
+    """ Remembers the encodings of messages, so that each message is serialized once 
+    for signing and once for the wire. Messages are signed over their codec encoding
+    up to the signature. On the wire they are msgpack by default, which decodes
+    several times faster than the codec. With the codec as 'dumps', the wire bytes
+    of a signed message are its signed bytes followed by the signature. Messages are
+    keyed by type and value, so equal messages share their encodings. """
+
+    def __init__(self, size=4096, dumps=None):
+        self.dumps = dumps if dumps is not None else pack
+        self.signed = dls_lru(size)
+        self.wire = dls_lru(size)
+
+    def signed_data(self, msg):
+        """ Returns the bytes covered by the signature of a message. """
+        key = (type(msg), msg[:-1])
+        data = self.signed.get(key)
+        if data is None:
+            data = signed_bytes(msg)
+            self.signed.put(key, data)
+        return data
+
+    def encode(self, msg):
+        """ Returns the bytes of a message on the wire. """
+        key = (type(msg), msg)
+        data = self.wire.get(key)
+        if data is None:
+            if self.dumps is encode and getattr(msg, "signature", None) is not None:
+                data = encode_signed(self.signed_data(msg), msg.signature)
+            else:
+                data = self.dumps(msg)
+            self.wire.put(key, data)
+        return data
+
+    def remember(self, msg, data):
+        """ Records the bytes a message was received as, so that it is not encoded again. """
+        key = (type(msg), msg)
+        if key not in self.wire:
+            self.wire.put(key, data)
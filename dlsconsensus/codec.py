@@ -0,0 +1,340 @@
+""" A schema based binary codec for the message types in types.py. Unlike the
+msgpack format in serialize.py, where every nested message, tuple or set is
+packed separately and wrapped in an ExtType, a message is encoded in a single
+pass into one buffer, and decoded in a single pass over a memoryview.
+
+Encoded messages start with a marker byte that msgpack never uses, followed by
+a version byte, so that both formats can be told apart on the same channel
+(see 'loads'). The signature is the last field of signed messages, so their
+encoding is the bytes they are signed over followed by the signature (see
+'signed_bytes' and 'encode_signed'). Several encoded messages for the same
+destination can be framed together in one envelope, that may be compressed
+(see 'frame'). The fields of each message type are encoded according to its
+schema, one character per field:
+
+    t : the type name, as one byte when it is the name of the message type.
+    u : an integer, as a zigzag varint.
+    v : any value, with a tag byte.
+"""
+
+import struct
+import threading
+import zlib
+
+from .types import *
+from .serialize import unpack
+
+MAGIC = 0xc1
+VERSION = 1
+ENVELOPE, ENVELOPE_ZLIB = 0x10, 0x11
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_STR, T_BYTES, T_TUPLE, T_LIST, T_SET, T_DICT, T_FLOAT, T_MSG = range(12)
+
+msg_types = [PHASE0, PHASE1LOCK, PHASE2ACK, RELEASE3, BLSDECISION, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSASK, BLSPUT, BLSFETCH, BLSPAYLOAD, BLSHEALTH, BLSBUSY, BLSSUBSCRIBE, BLSBLOCKS]
+msg_ids = dict((k, i) for i, k in enumerate(msg_types))
+
+schemas = {
+    PHASE0        : "tvuuv",
+    PHASE1LOCK    : "tvuvuv",
+    PHASE2ACK     : "tvuuv",
+    RELEASE3      : "tvuuv",
+    BLSDECISION   : "vtvuvv",
+    BLSACCEPTABLE : "vtvuuvv",
+    BLSLOCK       : "vtvuuvvv",
+    BLSACK        : "vtvuuvv",
+    BLSASK        : "vtvu",
+    BLSPUT        : "vtvv",
+    BLSFETCH      : "vtvuv",
+    BLSPAYLOAD    : "vtvvv",
+    BLSHEALTH     : "tuv",
+    BLSBUSY       : "vtvvu",
+    BLSSUBSCRIBE  : "vtvu",
+    BLSBLOCKS     : "vtvuvv",
+}
+
+for mtype in msg_types:
+    assert len(schemas[mtype]) == len(mtype._fields)
+
+FLOAT = struct.Struct(">d")
+
+
+class dls_encoder():
+    """ Encodes messages, reusing one growing buffer. """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def encode(self, msg):
+        buf = self.buf
+        del buf[:]
+        buf.append(MAGIC)
+        buf.append(VERSION)
+        self.value(msg)
+        return bytes(buf)
+
+    def encode_body(self, msg):
+        """ Encodes a message without its last field, the signature. """
+        buf = self.buf
+        del buf[:]
+        buf += bytes([ MAGIC, VERSION, T_MSG, msg_ids[type(msg)] ])
+        self.fields(msg, len(msg) - 1)
+        return bytes(buf)
+
+    def encode_value(self, x):
+        del self.buf[:]
+        self.value(x)
+        return bytes(self.buf)
+
+    def varint(self, n):
+        buf = self.buf
+        # Zigzag, so that small negative numbers are also short.
+        n = (n << 1) if n >= 0 else ((-n << 1) - 1)
+        while n >= 0x80:
+            buf.append((n & 0x7f) | 0x80)
+            n >>= 7
+        buf.append(n)
+
+    def blob(self, tag, data):
+        self.buf.append(tag)
+        self.varint(len(data))
+        self.buf += data
+
+    def value(self, x):
+        buf = self.buf
+        xt = type(x)
+
+        if x is None:
+            buf.append(T_NONE)
+        elif xt == bool:
+            buf.append(T_TRUE if x else T_FALSE)
+        elif xt == int:
+            buf.append(T_INT)
+            self.varint(x)
+        elif xt == str:
+            self.blob(T_STR, x.encode("utf-8"))
+        elif xt == bytes:
+            self.blob(T_BYTES, x)
+        elif xt in msg_ids:
+            buf.append(T_MSG)
+            buf.append(msg_ids[xt])
+            self.fields(x)
+        elif xt in (tuple, list, set):
+            buf.append(T_TUPLE if xt == tuple else T_LIST if xt == list else T_SET)
+            self.varint(len(x))
+            for item in x:
+                self.value(item)
+        elif xt == dict:
+            buf.append(T_DICT)
+            self.varint(len(x))
+            for k, v in x.items():
+                self.value(k)
+                self.value(v)
+        elif xt == float:
+            buf.append(T_FLOAT)
+            buf += FLOAT.pack(x)
+        else:
+            raise TypeError("Cannot encode type: %s" % xt)
+
+    def fields(self, msg, count=None):
+        name = type(msg).__name__
+        for kind, x in zip(schemas[type(msg)][:count], msg):
+            if kind == "v":
+                self.value(x)
+            elif kind == "u":
+                if type(x) != int:
+                    raise TypeError("Field must be an integer: %r" % (x, ))
+                self.varint(x)
+            elif x == name:
+                self.buf.append(0)
+            else:
+                self.buf.append(1)
+                self.value(x)
+
+
+def _varint(mv, pos):
+    """ Reads a zigzag varint, and returns it with the next position. """
+    b = mv[pos]
+    if b < 0x80:
+        return ((b >> 1) if not (b & 1) else -((b + 1) >> 1)), pos + 1
+
+    n = 0
+    shift = 0
+    while True:
+        b = mv[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return ((n >> 1) if not (n & 1) else -((n + 1) >> 1)), pos
+
+
+def _size(mv, pos):
+    """ Reads the size of a string or collection, each item of which takes at least a
+    byte, and checks it against the bytes left. """
+    size, pos = _varint(mv, pos)
+    if size < 0 or pos + size > len(mv):
+        raise ValueError("Bad size: %s" % size)
+    return size, pos
+
+
+def _value(mv, pos):
+    """ Reads a tagged value, and returns it with the next position. """
+    tag = mv[pos]
+    pos += 1
+
+    if tag == T_STR or tag == T_BYTES:
+        size, pos = _size(mv, pos)
+        end = pos + size
+        if tag == T_STR:
+            return str(mv[pos:end], "utf-8"), end
+        return mv[pos:end].tobytes(), end
+    elif tag == T_INT:
+        return _varint(mv, pos)
+    elif tag == T_MSG:
+        if mv[pos] >= len(msg_types):
+            raise ValueError("Unknown message id: %s" % mv[pos])
+        return _fields(mv, pos + 1, msg_types[mv[pos]])
+    elif tag == T_TUPLE or tag == T_LIST or tag == T_SET:
+        size, pos = _size(mv, pos)
+        items = []
+        for _ in range(size):
+            x, pos = _value(mv, pos)
+            items.append(x)
+        return (tuple(items) if tag == T_TUPLE else items if tag == T_LIST else set(items)), pos
+    elif tag == T_NONE:
+        return None, pos
+    elif tag == T_FALSE:
+        return False, pos
+    elif tag == T_TRUE:
+        return True, pos
+    elif tag == T_DICT:
+        size, pos = _size(mv, pos)
+        d = {}
+        for _ in range(size):
+            k, pos = _value(mv, pos)
+            d[k], pos = _value(mv, pos)
+        return d, pos
+    elif tag == T_FLOAT:
+        (x, ) = FLOAT.unpack_from(mv, pos)
+        return x, pos + FLOAT.size
+    raise ValueError("Unknown tag: %s" % tag)
+
+
+def _fields(mv, pos, mtype):
+    data = []
+    for kind in schemas[mtype]:
+        if kind == "v":
+            x, pos = _value(mv, pos)
+        elif kind == "u":
+            x, pos = _varint(mv, pos)
+        elif mv[pos] == 0:
+            x, pos = mtype.__name__, pos + 1
+        else:
+            x, pos = _value(mv, pos + 1)
+        data.append(x)
+    return mtype._make(data), pos
+
+
+_local = threading.local()
+
+
+def _encoder():
+    if not hasattr(_local, "encoder"):
+        _local.encoder = dls_encoder()
+    return _local.encoder
+
+
+def encode(msg):
+    """ Encodes a message, or any value made of the supported types. """
+    return _encoder().encode(msg)
+
+
+def signed_bytes(msg):
+    """ Returns the bytes covered by the signature of a message: its encoding, up to the
+    signature, which is the last field. """
+    return _encoder().encode_body(msg)
+
+
+def encode_signed(body, signature):
+    """ Returns the encoding of a signed message, from its signed bytes and signature, 
+    without encoding the other fields again. It is the same as encode(msg). """
+    return body + _encoder().encode_value(signature)
+
+
+def decode(data):
+    """ Decodes a message from bytes, in one pass over a memoryview. Raises ValueError if
+    the data is not a valid encoding. """
+    mv = memoryview(data)
+    if len(mv) < 2 or mv[0] != MAGIC:
+        raise ValueError("Not an encoded message.")
+    if mv[1] != VERSION:
+        raise ValueError("Unknown codec version: %s" % mv[1])
+
+    # Reads past the end, bad text, and values that cannot be set items or dict keys.
+    try:
+        x, pos = _value(mv, 2)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError, RecursionError) as e:
+        raise ValueError("Broken data: %s" % e)
+    if pos != len(mv):
+        raise ValueError("Trailing data.")
+    return x
+
+
+def is_encoded(data):
+    """ Returns whether data is in this format, rather than msgpack. """
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def loads(data):
+    """ Decodes data in either this format or the msgpack format of serialize.py. """
+    if is_encoded(data):
+        return decode(data)
+    return unpack(data)
+
+
+def frame(datas, compress=False):
+    """ Frames encoded messages, in any format, into one envelope. """
+    enc = dls_encoder()
+    enc.varint(len(datas))
+    for data in datas:
+        enc.varint(len(data))
+    head = bytes(enc.buf)
+
+    body = b"".join([ head ] + list(datas))
+    if compress:
+        return bytes([ MAGIC, ENVELOPE_ZLIB ]) + zlib.compress(body)
+    return bytes([ MAGIC, ENVELOPE ]) + body
+
+
+def is_envelope(data):
+    return len(data) > 1 and data[0] == MAGIC and data[1] in (ENVELOPE, ENVELOPE_ZLIB)
+
+
+def unframe(data):
+    """ Returns the encoded messages in an envelope. """
+    if not is_envelope(data):
+        raise ValueError("Not an envelope.")
+
+    try:
+        body = data[2:] if data[1] == ENVELOPE else zlib.decompress(data[2:])
+        mv = memoryview(body)
+
+        size, pos = _size(mv, 0)
+        lens = []
+        for _ in range(size):
+            n, pos = _varint(mv, pos)
+            lens.append(n)
+    except (zlib.error, IndexError):
+        raise ValueError("Broken envelope.")
+
+    datas = []
+    for n in lens:
+        if n < 0 or pos + n > len(mv):
+            raise ValueError("Truncated envelope.")
+        datas.append(mv[pos:pos + n].tobytes())
+        pos += n
+
+    if pos != len(mv):
+        raise ValueError("Trailing data.")
+    return datas
@@ -0,0 +1,100 @@
+""" Signature backends for the network peer. A signer signs and verifies byte
+strings with the keys held by the peer ('priv' and the 'pubs' of all peers),
+and can verify a whole batch of signatures at once, optionally spread over an
+executor such as a process pool. """
+
+from hashlib import sha256
+
+
+def _verify_chunk(args):
+    signer_type, chunk = args
+    signer = signer_type()
+    return signer.verify_many(chunk)
+
+
+class dls_signer():
+    """ The interface of signature backends. """
+
+    BATCH_CHUNK = 64
+
+    def __init__(self, executor=None):
+        self.executor = executor
+
+    def sign(self, priv, data):
+        raise NotImplementedError()
+
+    def verify(self, pub, data, signature):
+        raise NotImplementedError()
+
+    def verify_many(self, items):
+        """ Verifies a list of (pub, data, signature), one by one. """
+        return [ self.verify(pub, data, signature) for (pub, data, signature) in items ]
+
+    def verify_batch(self, items):
+        """ Verifies a list of (pub, data, signature), and returns a list of booleans. """
+        items = list(items)
+        if self.executor is None or len(items) <= self.BATCH_CHUNK:
+            return self.verify_many(items)
+
+        chunks = [ (type(self), items[i:i + self.BATCH_CHUNK])
+                   for i in range(0, len(items), self.BATCH_CHUNK) ]
+        results = []
+        for res in self.executor.map(_verify_chunk, chunks):
+            results += res
+        return results
+
+
+class dls_hash_signer(dls_signer):
+    """ Signatures that are only a hash of the data, and authenticate nothing. For tests. """
+
+    def sign(self, priv, data):
+        return sha256(data).hexdigest()
+
+    def verify(self, pub, data, signature):
+        return sha256(data).hexdigest() == signature
+
+
+class dls_ed25519_signer(dls_signer):
+    """ Ed25519 signatures, using the 'cryptography' package. Keys are raw 32 byte strings. """
+
+    def __init__(self, executor=None):
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from cryptography.exceptions import InvalidSignature
+
+        dls_signer.__init__(self, executor)
+        self.ed25519 = ed25519
+        self.InvalidSignature = InvalidSignature
+        self.keys = {}
+
+    @staticmethod
+    def generate_keys():
+        """ Returns a new (priv, pub) pair of raw keys. """
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from cryptography.hazmat.primitives import serialization
+
+        key = ed25519.Ed25519PrivateKey.generate()
+        priv = key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                                 serialization.NoEncryption())
+        pub = key.public_key().public_bytes(serialization.Encoding.Raw,
+                                            serialization.PublicFormat.Raw)
+        return priv, pub
+
+    def _key(self, raw, private):
+        if raw not in self.keys:
+            if private:
+                self.keys[raw] = self.ed25519.Ed25519PrivateKey.from_private_bytes(raw)
+            else:
+                self.keys[raw] = self.ed25519.Ed25519PublicKey.from_public_bytes(raw)
+        return self.keys[raw]
+
+    def sign(self, priv, data):
+        return self._key(priv, True).sign(data)
+
+    def verify(self, pub, data, signature):
+        if not isinstance(signature, bytes):
+            return False
+        try:
+            self._key(pub, False).verify(signature, data)
+            return True
+        except (self.InvalidSignature, ValueError):
+            return False
@@ -0,0 +1,245 @@
+""" An asyncio driver for a network peer. It listens on, and connects to, TCP or
+Unix sockets, exchanges length prefixed envelopes (see 'get_envelopes') over
+one persistent connection per peer (see transport.py), processes inbound
+messages as soon as they arrive, and advances rounds from a pacemaker timer,
+or as soon as all the messages a round waits for are in.
+
+Endpoints map the address of each peer to either a (host, port) pair for TCP,
+or a path for a Unix socket. """
+
+import asyncio
+import time
+
+from .transport import dls_transport
+
+
+class dls_pacemaker():
+    """ Decides how long each round lasts. Rounds have a fixed duration. """
+
+    def __init__(self, round_time=0.05):
+        assert round_time > 0
+        self.round_time = round_time
+
+    def timeout(self, rtype=None):
+        """ Returns the duration of the next round, of type rtype, in seconds. """
+        return self.round_time
+
+    def observe(self, rtype, elapsed):
+        """ Records that a round of type rtype got all its messages after 'elapsed'. """
+        pass
+
+    def end_phase(self, decided):
+        """ Records the end of a phase, and whether a block was decided. """
+        pass
+
+
+class dls_adaptive_pacemaker(dls_pacemaker):
+    """ Sizes each round type to a margin over the time its messages were seen to take,
+    and backs off exponentially after each phase that does not decide, once more than
+    'grace' phases in a row did not. Some phases fail even in good conditions, as when
+    a block starts in the middle of a phase, or its leader is faulty. 
+    
+    Only the timing of rounds adapts, which the protocol tolerates: it is safe
+    whatever the timing, and live as soon as rounds are long enough. """
+
+    def __init__(self, round_time=0.05, min_time=0.001, max_time=10.0, margin=2.0, 
+                 alpha=0.25, backoff=2.0, grace=4):
+        assert 0 < min_time <= round_time <= max_time
+        dls_pacemaker.__init__(self, round_time)
+        self.min_time = min_time
+        self.max_time = max_time
+        self.margin = margin
+        self.alpha = alpha
+        self.backoff = backoff
+        self.grace = grace # Phases without a decision before backing off.
+
+        self.estimates = [ None ] * 4 # Moving average of the message time, per round type.
+        self.failures = 0
+
+    def timeout(self, rtype=None):
+        est = self.estimates[rtype] if rtype is not None else None
+        base = min(est * self.margin, self.round_time) if est is not None else self.round_time
+        t = base * (self.backoff ** max(0, self.failures - self.grace))
+        return min(self.max_time, max(self.min_time, t))
+
+    def observe(self, rtype, elapsed):
+        est = self.estimates[rtype]
+        self.estimates[rtype] = elapsed if est is None else (1 - self.alpha) * est + self.alpha * elapsed
+
+    def end_phase(self, decided):
+        if decided:
+            self.failures = 0
+        elif self.min_time * (self.backoff ** max(0, self.failures - self.grace)) < self.max_time:
+            self.failures += 1
+
+
+def round_ready(peer, pacemaker, round_started, observe=True):
+    """ Returns whether the current round of a peer may end early, and the later round to
+    catch up with, if any. Rounds that end with all their messages in are observed by
+    the pacemaker, unless 'observe' is unset. """
+    jump = peer.sync_round()
+    if jump is not None:
+        return True, jump
+    if not peer.round_complete():
+        return False, None
+    if observe:
+        rtype = peer.sm.get_round_type(peer.round)
+        pacemaker.observe(rtype, time.monotonic() - round_started)
+    return True, None
+
+
+def advance_round(peer, pacemaker, set_round=None):
+    """ Advances the round of a peer, tells the pacemaker whether a phase ended with a
+    decision, and returns the blocks committed. """
+    bno = peer.current_block_no
+    rtype = peer.sm.get_round_type(peer.round)
+    peer.advance_round(set_round)
+
+    # A pipelined peer may commit several blocks at once.
+    blocks = peer.seq.old_blocks[bno - peer.current_block_no:] if peer.current_block_no > bno else []
+    if len(blocks) > 0:
+        pacemaker.end_phase(True)
+    elif rtype == 3:
+        pacemaker.end_phase(False)
+    return blocks
+
+
+class dls_driver():
+    """ Runs a network peer on an asyncio event loop. """
+
+    def __init__(self, peer, endpoints, pacemaker=None, compress=False):
+        self.peer = peer
+        self.endpoints = endpoints
+        self.pacemaker = pacemaker if pacemaker is not None else dls_pacemaker()
+        self.compress = compress
+        self.transport = dls_transport(self.receive, lambda dest: self.endpoints[dest])
+
+        self.wake = asyncio.Event() # Set when the current round is complete.
+        self.round_started = None
+        self.jump = None # A later round to catch up with.
+        self.expired = False # Whether the current round timed out.
+
+        # Metrics
+        self.rounds = 0
+        self.early_rounds = 0
+        self.started = None
+        self.block_started = None
+        self.block_latencies = []
+        self.submitted = {} # item -> time of submission
+        self.commit_latencies = []
+        self.committed = 0
+
+    # Inbound.
+
+    async def start(self, listen=None):
+        """ Starts listening, by default on the endpoint of the peer, and the pacemaker.
+        Returns the endpoint actually listened on. """
+        if listen is None:
+            listen = self.endpoints[self.peer.my_addr()]
+
+        endpoint = await self.transport.listen(listen)
+        self.endpoints[self.peer.my_addr()] = endpoint
+
+        self.started = self.block_started = self.round_started = time.monotonic()
+        self.transport.spawn(self.pace())
+        return endpoint
+
+    def receive(self, data):
+        """ Processes an envelope, and sends out any reply at once. """
+        try:
+            self.peer.put_envelope(data)
+        except Exception:
+            self.transport.dropped_frames += 1
+            return
+        self.flush()
+        self.check_complete()
+
+    # Outbound.
+
+    def flush(self):
+        """ Queues one frame per destination, with all pending messages. """
+        for dest, env in self.peer.get_envelopes(self.compress):
+            self.transport.send(dest, env)
+
+    # Rounds.
+
+    async def pace(self):
+        """ Advances a round when the pacemaker timer expires, or earlier when the round
+        is complete. """
+        loop = asyncio.get_running_loop()
+        while True:
+            rtype = self.peer.sm.get_round_type(self.peer.round)
+            timer = loop.call_later(self.pacemaker.timeout(rtype), self.expire)
+            try:
+                await self.wake.wait()
+            finally:
+                timer.cancel()
+
+            if not self.expired:
+                self.early_rounds += 1
+            self.step(self.jump)
+
+    def expire(self):
+        self.expired = True
+        self.wake.set()
+
+    def check_complete(self, observe=True):
+        """ Ends the current round early, if all its messages are in, or if enough peers
+        are already in a later phase. """
+        if self.wake.is_set():
+            return
+
+        ready, self.jump = round_ready(self.peer, self.pacemaker, self.round_started, observe)
+        if ready:
+            self.wake.set()
+
+    def step(self, set_round=None):
+        self.wake.clear()
+        self.expired = False
+        self.jump = None
+        for block in advance_round(self.peer, self.pacemaker, set_round):
+            self.record_block(block)
+        self.rounds += 1
+
+        self.round_started = time.monotonic()
+        self.flush()
+
+        # Messages already in say nothing of how long rounds should be.
+        self.check_complete(observe=False)
+
+    def record_block(self, block):
+        now = time.monotonic()
+        self.block_latencies.append(now - self.block_started)
+        self.block_started = now
+        self.committed += len(block)
+
+        for item in block:
+            if item in self.submitted:
+                self.commit_latencies.append(now - self.submitted.pop(item))
+
+    def submit(self, item):
+        """ Schedules an item to be sequenced, and times until it is committed. Returns
+        False if the peer refused it, as its pool of pending items is full. """
+        if not self.peer.put_sequence(item):
+            return False
+        self.submitted.setdefault(item, time.monotonic())
+        return True
+
+    def stats(self):
+        """ Returns the throughput, in committed items per second, and latencies. """
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        mean = lambda xs: sum(xs) / len(xs) if len(xs) > 0 else None
+        stats = { "elapsed": elapsed,
+                  "rounds": self.rounds,
+                  "early_rounds": self.early_rounds,
+                  "blocks": len(self.block_latencies),
+                  "committed": self.committed,
+                  "throughput": self.committed / elapsed if elapsed > 0 else 0.0,
+                  "block_latency": mean(self.block_latencies),
+                  "commit_latency": mean(self.commit_latencies),
+                  "mempool": self.peer.seq.to_be_sequenced.stats() }
+        stats.update(self.transport.stats())
+        return stats
+
+    async def stop(self):
+        await self.transport.stop()
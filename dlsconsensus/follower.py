@@ -0,0 +1,81 @@
+""" A client that follows the decided blocks of a channel, by subscribing to a
+peer (see BLSSUBSCRIBE). It checks that each block comes with the decisions of
+N-f peers on it, and acknowledges the blocks it consumed by subscribing again
+from the next one, which lets the peer send more. """
+
+from collections import deque
+
+from .types import BLSSUBSCRIBE, BLSBLOCKS, BLSDECISION
+from .codec import signed_bytes
+from .crypto import dls_hash_signer
+from .net import payload_digest
+
+
+class dls_follower():
+    """ Receives and checks the decided blocks of a channel, in order. """
+
+    BLSSUBSCRIBE = "BLSSUBSCRIBE"
+
+    def __init__(self, my_addr, addrs, pubs, channel_id, start_bno=0, signer=None, 
+                 payload_digests=False, buffer=256):
+        assert len(addrs) == len(pubs)
+        self.my_addr = my_addr
+        self.addrs = addrs
+        self.pubs = pubs
+        self.channel_id = channel_id
+        self.signer = signer if signer is not None else dls_hash_signer()
+        self.payload_digests = payload_digests
+
+        self.N = len(addrs)
+        self.f = (self.N - 1) // 3
+        self.next_bno = start_bno # The next block to receive.
+        self.ready = deque()      # (bno, block), received but not consumed.
+        self.buffer = buffer      # Blocks held before asking for no more.
+
+        # Metrics
+        self.rejected = 0
+
+    def get_subscribe(self):
+        """ Returns the message that asks for the blocks not yet received, and
+        acknowledges the others, or None while the buffer is full. """
+        if len(self.ready) >= self.buffer:
+            return None
+        return BLSSUBSCRIBE(self.channel_id, self.BLSSUBSCRIBE, self.my_addr, self.next_bno)
+
+    def check_certificate(self, bno, block, cert):
+        """ Returns whether N-f distinct peers signed decisions on a block. """
+        value = payload_digest(block) if self.payload_digests else block
+        senders = set()
+        for d in cert:
+            if type(d) != BLSDECISION or d.channel != self.channel_id or d.bno != bno \
+                    or d.block != value or d.sender not in self.addrs or d.sender in senders:
+                continue
+            pub = self.pubs[self.addrs.index(d.sender)]
+            if self.signer.verify(pub, signed_bytes(d), d.signature):
+                senders.add(d.sender)
+        return len(senders) >= self.N - self.f
+
+    def put_blocks(self, msg):
+        """ Takes in the blocks of a BLSBLOCKS message that come next, if their 
+        certificates check. Returns the number of blocks taken. """
+        if type(msg) != BLSBLOCKS or msg.channel != self.channel_id \
+                or len(msg.blocks) != len(msg.certificates):
+            return 0
+
+        taken = 0
+        for i, (block, cert) in enumerate(zip(msg.blocks, msg.certificates)):
+            bno = msg.bno + i
+            if bno < self.next_bno:
+                continue
+            if bno > self.next_bno or not self.check_certificate(bno, block, cert):
+                self.rejected += 1
+                break
+            self.ready.append((bno, block))
+            self.next_bno += 1
+            taken += 1
+        return taken
+
+    def get_blocks(self, limit=None):
+        """ Returns the received blocks, in order, as (bno, block), up to 'limit'. """
+        n = len(self.ready) if limit is None else min(limit, len(self.ready))
+        return [ self.ready.popleft() for _ in range(n) ]
@@ -0,0 +1,254 @@
+""" A host that runs the network peers of many shards, one per channel, in one
+asyncio event loop. Messages of all shards to the same destination share one
+persistent connection, and are framed together in one envelope per flush.
+Inbound messages are routed to their peer by channel, and the rounds of all
+shards are timed by one timer wheel, rather than one timer task per shard.
+
+Channels can be partitioned across worker processes (see 'shard_of'), each
+running a host for its own channels on its own endpoint, to use every core.
+Endpoints then map the address of each peer to a list of endpoints, one per
+worker, and messages of a channel go to the worker of the channel. """
+
+import asyncio
+import math
+import multiprocessing
+import time
+from hashlib import sha256
+
+from .codec import frame, unframe, loads
+from .serialize import pack
+from .driver import dls_pacemaker, round_ready, advance_round
+from .transport import dls_transport
+
+
+def shard_of(channel, workers):
+    """ Returns the worker that runs a channel, the same on all hosts. """
+    if workers == 1:
+        return 0
+    return int.from_bytes(sha256(pack(channel)).digest()[:8], "big") % workers
+
+
+def spawn_workers(main, workers):
+    """ Starts one process per worker, running main(worker), which should build and run
+    the host for the channels of the worker. Returns the processes. """
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ ctx.Process(target=main, args=(w, ), daemon=True) for w in range(workers) ]
+    for p in procs:
+        p.start()
+    return procs
+
+
+class dls_timer_wheel():
+    """ A hashed timer wheel. Timers fall in slots of 'tick' seconds, so that setting,
+    cancelling and expiring a timer costs the same however many are set. """
+
+    def __init__(self, tick=0.001, slots=1024, now=0.0):
+        assert tick > 0 and slots > 0
+        self.tick = tick
+        self.wheel = [ {} for _ in range(slots) ] # key -> deadline, in ticks
+        self.deadlines = {} # key -> deadline, in ticks
+        self.current = self.ticks(now) # The last tick expired.
+
+    def ticks(self, t):
+        # Allow for the rounding of times that are a whole number of ticks.
+        return int(math.floor(t / self.tick + 1e-9))
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, delay, now):
+        """ Sets the timer of a key to expire after 'delay', replacing any other. """
+        self.cancel(key)
+        deadline = max(self.current + 1, int(math.ceil((now + delay) / self.tick - 1e-9)))
+        self.wheel[deadline % len(self.wheel)][key] = deadline
+        self.deadlines[key] = deadline
+
+    def cancel(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            del self.wheel[deadline % len(self.wheel)][key]
+
+    def advance(self, now):
+        """ Returns the keys whose timers expired by 'now', and clears them. """
+        target = self.ticks(now)
+        expired = []
+        # Timers further than a turn away stay in their slot until their turn.
+        for t in range(self.current + 1, min(target, self.current + len(self.wheel)) + 1):
+            slot = self.wheel[t % len(self.wheel)]
+            for key, deadline in list(slot.items()):
+                if deadline <= target:
+                    del slot[key]
+                    del self.deadlines[key]
+                    expired.append(key)
+        self.current = max(self.current, target)
+        return expired
+
+
+class dls_shard():
+    """ The round state of one shard on a host. """
+
+    def __init__(self, peer, pacemaker):
+        self.peer = peer
+        self.pacemaker = pacemaker
+        self.round_started = None
+        self.rounds = 0
+        self.early_rounds = 0
+        self.blocks = 0
+        self.committed = 0
+
+
+class dls_shard_host():
+    """ Runs the network peers of many shards on one asyncio event loop. """
+
+    def __init__(self, endpoints, compress=False, tick=0.001, workers=1, worker=0):
+        assert 0 <= worker < workers
+        self.endpoints = endpoints
+        self.compress = compress
+        self.workers = workers
+        self.worker = worker
+
+        self.shards = {} # channel -> dls_shard
+        self.dirty = set() # Shards that may have messages to send.
+        self.wheel = dls_timer_wheel(tick, now=time.monotonic())
+        self.transport = dls_transport(self.receive) # Frames go to endpoints directly.
+
+        # Metrics
+        self.dropped_messages = 0
+        self.started = None
+
+    def add_peer(self, peer, pacemaker=None):
+        """ Runs the peer of a shard on this host. Its channel must belong to the worker. """
+        assert shard_of(peer.channel_id, self.workers) == self.worker
+        assert peer.channel_id not in self.shards
+        shard = dls_shard(peer, pacemaker if pacemaker is not None else dls_pacemaker())
+        self.shards[peer.channel_id] = shard
+        if self.started is not None:
+            self.start_round(shard)
+        return shard
+
+    def endpoint(self, dest, channel):
+        """ Returns the endpoint of the worker of dest that runs a channel, or None. """
+        endpoint = self.endpoints.get(dest)
+        return endpoint[shard_of(channel, self.workers)] if isinstance(endpoint, list) else endpoint
+
+    # Inbound.
+
+    async def start(self, listen):
+        """ Starts listening, on a (host, port) pair or a Unix socket path, and the timer
+        wheel. Returns the endpoint actually listened on. """
+        endpoint = await self.transport.listen(listen)
+
+        self.started = time.monotonic()
+        for shard in self.shards.values():
+            self.start_round(shard)
+        self.transport.spawn(self.pace())
+        return endpoint
+
+    def receive(self, data):
+        """ Routes the messages of an envelope to their shards, and sends out any reply
+        at once. """
+        try:
+            msgs = [ loads(d) for d in unframe(data) ]
+        except Exception:
+            self.transport.dropped_frames += 1
+            return
+
+        batches = {}
+        for msg in msgs:
+            shard = self.shards.get(getattr(msg, "channel", None))
+            if shard is None:
+                self.dropped_messages += 1
+                continue
+            batches.setdefault(shard, []).append(msg)
+
+        for shard, batch in batches.items():
+            self.dirty.add(shard)
+            try:
+                shard.peer.put_messages(batch)
+            except Exception:
+                self.dropped_messages += len(batch)
+
+        for shard in batches:
+            self.check_complete(shard)
+        self.flush()
+
+    # Outbound.
+
+    def flush(self):
+        """ Queues one frame per destination, with the pending messages of all shards. """
+        out = {}
+        dirty, self.dirty = self.dirty, set()
+        for shard in dirty:
+            peer = shard.peer
+            for dest, msgs in peer.get_batches().items():
+                endpoint = self.endpoint(dest, peer.channel_id)
+                if endpoint is None:
+                    self.dropped_messages += len(msgs)
+                    continue
+                out.setdefault(endpoint, []).extend(peer.encode(msg) for msg in msgs)
+
+        for endpoint, datas in out.items():
+            self.transport.send(endpoint, frame(datas, self.compress))
+
+    # Rounds.
+
+    async def pace(self):
+        """ Advances the rounds of the shards whose timers expired, every tick. """
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            expired = self.wheel.advance(time.monotonic())
+            for channel in expired:
+                self.step(self.shards[channel])
+            if len(expired) > 0:
+                self.flush()
+
+    def start_round(self, shard):
+        shard.round_started = time.monotonic()
+        rtype = shard.peer.sm.get_round_type(shard.peer.round)
+        self.wheel.schedule(shard.peer.channel_id, shard.pacemaker.timeout(rtype), shard.round_started)
+
+    def check_complete(self, shard):
+        """ Ends the current round of a shard early, if all its messages are in, or if
+        enough peers are already in a later phase. """
+        ready, jump = round_ready(shard.peer, shard.pacemaker, shard.round_started)
+        if ready:
+            shard.early_rounds += 1
+            self.step(shard, jump)
+
+    MAX_STEPS = 4 # Rounds a shard may advance at once, before others get their turn.
+
+    def step(self, shard, set_round=None):
+        # Messages already in say nothing of how long rounds should be, so rounds that
+        # are complete at once are not observed.
+        for _ in range(self.MAX_STEPS):
+            for block in advance_round(shard.peer, shard.pacemaker, set_round):
+                shard.blocks += 1
+                shard.committed += len(block)
+            shard.rounds += 1
+            self.dirty.add(shard)
+
+            self.start_round(shard)
+            ready, set_round = round_ready(shard.peer, shard.pacemaker, shard.round_started, False)
+            if not ready:
+                break
+            shard.early_rounds += 1
+
+    def stats(self):
+        """ Returns the throughput of all shards, in committed items per second. """
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        committed = sum(s.committed for s in self.shards.values())
+        stats = { "elapsed": elapsed,
+                  "shards": len(self.shards),
+                  "rounds": sum(s.rounds for s in self.shards.values()),
+                  "early_rounds": sum(s.early_rounds for s in self.shards.values()),
+                  "blocks": sum(s.blocks for s in self.shards.values()),
+                  "committed": committed,
+                  "throughput": committed / elapsed if elapsed > 0 else 0.0,
+                  "timers": len(self.wheel),
+                  "connections": len(self.transport.senders),
+                  "dropped_messages": self.dropped_messages }
+        stats.update(self.transport.stats())
+        return stats
+
+    async def stop(self):
+        await self.transport.stop()
@@ -0,0 +1,100 @@
+""" An ingest stage in front of the network peer. Raw inbound messages are
+decoded and their signatures checked on an executor (a thread or process
+pool), and the peer is then fed only the valid messages, in arrival order,
+so that the single threaded state machine never does this work itself. """
+
+from collections import deque
+
+from .codec import unframe, loads, signed_bytes
+from .net import dls_net_peer
+
+_signers = {}
+
+
+def _ingest_chunk(args):
+    """ Decodes and verifies a chunk of raw messages. Runs on the executor. """
+    signer_type, addrs, pubs, raws = args
+    if signer_type not in _signers:
+        _signers[signer_type] = signer_type()
+    signer = _signers[signer_type]
+
+    results = []
+    for raw in raws:
+        try:
+            # Either wire format, as envelopes may carry both.
+            msg = loads(raw)
+        except Exception:
+            results += [ None ]
+            continue
+
+        ok = True
+        for m in dls_net_peer.signed_messages([ msg ]):
+            if m.signature is None or m.sender not in addrs:
+                ok = False
+                break
+            pub = pubs[addrs.index(m.sender)]
+            if not signer.verify(pub, signed_bytes(m), m.signature):
+                ok = False
+                break
+
+        results += [ msg if ok else None ]
+    return results
+
+
+class dls_ingest():
+    """ Decodes and verifies raw messages for a peer, on an executor. """
+
+    CHUNK = 32
+
+    def __init__(self, peer, executor=None):
+        self.peer = peer
+        self.executor = executor
+        self.pending = deque()  # Results or futures, in arrival order.
+
+        # Metrics
+        self.accepted = 0
+        self.dropped_invalid = 0
+
+    def submit(self, raws):
+        """ Queues raw inbound messages for decoding and verification. """
+        raws = list(raws)
+        peer = self.peer
+        for i in range(0, len(raws), self.CHUNK):
+            args = (type(peer.signer), peer.addrs, peer.pubs, raws[i:i + self.CHUNK])
+            if self.executor is None:
+                self.pending.append((_ingest_chunk(args), args[3]))
+            else:
+                self.pending.append((self.executor.submit(_ingest_chunk, args), args[3]))
+
+    def submit_envelope(self, data):
+        """ Queues the messages framed in an envelope. """
+        self.submit(unframe(data))
+
+    def ready(self, wait=False):
+        """ Returns the messages decoded so far, in arrival order. Stops at the first
+        chunk still in progress, unless 'wait' is set. """
+        msgs = []
+        while len(self.pending) > 0:
+            head, raws = self.pending[0]
+            if not isinstance(head, list):
+                if not (wait or head.done()):
+                    break
+                head = head.result()
+            self.pending.popleft()
+
+            for msg, raw in zip(head, raws):
+                if msg is None:
+                    self.dropped_invalid += 1
+                else:
+                    # Keep the bytes, in case the message is sent on.
+                    self.peer.encodings.remember(msg, raw)
+                    self.accepted += 1
+                    msgs += [ msg ]
+        return msgs
+
+    def drain(self, wait=False):
+        """ Feeds the peer the messages decoded so far, and returns how many. """
+        msgs = self.ready(wait)
+        if len(msgs) > 0:
+            self.peer.put_messages(msgs, verified=True)
+        return len(msgs)
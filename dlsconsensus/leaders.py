@@ -0,0 +1,72 @@
+""" A leader schedule that skips leaders that recently failed. Each peer notes
+which leaders it did not hear from in their phase, and its proposals carry the
+leaders it suspects in a BLSHEALTH entry. The entry of a decided block bno
+then sets the schedule of block bno + lag, so that all correct peers, having
+decided the same blocks, use the same schedule. With a pipeline of blocks in
+progress at once, the lag is its length, so that the schedule of a block is
+fixed before it starts, and does not change as earlier blocks commit.
+
+Every other turn, the phase of a suspected leader goes to a healthy peer
+instead. Suspected leaders keep the other turns, since a correct peer that
+lags behind may only catch up in its own phases. At most f peers are
+suspected, and a peer is healthy again unless the next decided block
+suspects it anew, so a faulty proposer can only shift some phases from
+correct leaders to others, for one block. Safety does not depend on the
+schedule, as long as peers agree on it per block. """
+
+from .types import BLSHEALTH
+
+
+class dls_leader_schedule():
+    """ Tracks the health of leaders, and maps phases to leaders. """
+
+    SUSPECT_AFTER = 2 # Silent phases in a row.
+
+    def __init__(self, N, lag=1):
+        assert lag >= 1
+        self.N = N
+        self.f = (N - 1) // 3
+        self.lag = lag
+
+        self.failures = [ 0 ] * N  # Own phases in a row they were silent in, as seen locally.
+        self.suspects = ()         # As agreed in the last decided block.
+        self.decided = {}          # bno -> suspects, of the last 'lag' decided blocks.
+
+    def leader(self, phase, suspects=None):
+        """ Returns the leader of a phase, by default as set by the last decided block. """
+        if suspects is None:
+            suspects = self.suspects
+
+        l = phase % self.N
+        if l not in suspects or (phase // self.N) % 2 == 1:
+            return l
+
+        healthy = [ i for i in range(self.N) if i not in suspects ]
+        return healthy[phase % len(healthy)]
+
+    def leaders(self, bno):
+        """ Returns the map of phases to leaders of block bno, which block bno - lag set. """
+        suspects = self.decided.get(bno - self.lag, ())
+        return lambda phase: self.leader(phase, suspects)
+
+    def observe(self, leader, alive):
+        """ Records whether a leader was heard from in its phase. """
+        self.failures[leader] = 0 if alive else self.failures[leader] + 1
+
+    def health_entry(self, bno):
+        """ Returns the entry to add to our proposal for block bno: the leaders that
+        were silent in their last phases, at most f of them, the most silent first. """
+        failed = sorted((-n, i) for i, n in enumerate(self.failures) if n >= self.SUSPECT_AFTER)
+        return BLSHEALTH("BLSHEALTH", bno, tuple(sorted(i for _, i in failed[:self.f])))
+
+    def is_valid(self, entry, bno):
+        return type(entry) == BLSHEALTH and entry.bno == bno and type(entry.suspects) == tuple \
+            and len(entry.suspects) <= self.f and len(set(entry.suspects)) == len(entry.suspects) \
+            and all(type(i) == int and 0 <= i < self.N for i in entry.suspects)
+
+    def apply(self, bno, block):
+        """ Sets the schedule after block bno is decided, from its first valid entry. """
+        entries = [ e for e in block if self.is_valid(e, bno) ]
+        self.suspects = entries[0].suspects if len(entries) > 0 else ()
+        self.decided[bno] = self.suspects
+        self.decided.pop(bno - self.lag, None)
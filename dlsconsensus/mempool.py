@@ -0,0 +1,138 @@
+""" A bounded pool of the items waiting to be sequenced. Items are proposed in
+arrival order, or by priority, and blocks are capped in items and in bytes, so
+that a backlog is spread over several blocks rather than put in one. Once the
+pool holds 'capacity' items, new ones are refused, and the peer tells their
+sender to back off (see BLSBUSY). """
+
+import heapq
+import time
+from itertools import count
+
+from .serialize import pack
+
+
+class dls_mempool():
+    """ Items waiting to be sequenced. Compares equal to the set of its items. """
+
+    def __init__(self, capacity=None, max_items=None, max_bytes=None, priority=None):
+        assert capacity is None or capacity > 0
+        assert max_items is None or max_items > 0
+        assert max_bytes is None or max_bytes > 0
+        self.capacity = capacity
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.priority = priority # item -> key, lower keys are proposed first.
+
+        self.items = {} # item -> (arrival no, arrival time, size), in arrival order
+        self.heap = []  # (key, arrival no, item), with removed items left in for a while
+        self.arrivals = count()
+
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.removed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __eq__(self, other):
+        if isinstance(other, dls_mempool):
+            return self.items.keys() == other.items.keys()
+        return self.items.keys() == other
+
+    def is_full(self):
+        return self.capacity is not None and len(self.items) >= self.capacity
+
+    def add(self, item):
+        """ Adds an item, and returns whether it is in the pool. Returns False if the pool
+        is full. """
+        if item in self.items:
+            return True
+        if self.is_full():
+            self.rejected += 1
+            return False
+
+        n = next(self.arrivals)
+        size = len(pack(item)) if self.max_bytes is not None else 0
+        self.items[item] = (n, time.monotonic(), size)
+        if self.priority is not None:
+            heapq.heappush(self.heap, (self.priority(item), n, item))
+        self.admitted += 1
+        self.max_depth = max(self.max_depth, len(self.items))
+        return True
+
+    def discard(self, item):
+        """ Removes an item, once sequenced. """
+        entry = self.items.pop(item, None)
+        if entry is None:
+            return
+        wait = time.monotonic() - entry[1]
+        self.removed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+        # Removed items stay in the heap, until it is mostly made of them.
+        if len(self.heap) > 2 * len(self.items) + 64:
+            self.heap = [ e for e in self.heap if self.is_live(e) ]
+            heapq.heapify(self.heap)
+
+    def is_live(self, entry):
+        """ Returns whether a heap entry is for an item still in the pool. """
+        return self.items.get(entry[2], (None,))[0] == entry[1]
+
+    def remove_all(self, items):
+        for item in items:
+            self.discard(item)
+
+    def ordered(self):
+        """ Yields the items in the order they are proposed. """
+        if self.priority is None:
+            yield from self.items
+            return
+
+        # Walk the heap in order, from the root, without popping.
+        frontier = [ (self.heap[0], 0) ] if len(self.heap) > 0 else []
+        while len(frontier) > 0:
+            entry, i = heapq.heappop(frontier)
+            if self.is_live(entry):
+                yield entry[2]
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self.heap):
+                    heapq.heappush(frontier, (self.heap[child], child))
+
+    def take(self, exclude=(), limit=None):
+        """ Returns the items of the next block, in order, skipping those in 'exclude', and
+        within the block size limits, and 'limit' items. """
+        limit = min(x for x in (limit, self.max_items, len(self.items)) if x is not None)
+        block = []
+        size = 0
+        for item in self.ordered():
+            if len(block) >= limit:
+                break
+            if item in exclude:
+                continue
+            if self.max_bytes is not None:
+                if size + self.items[item][2] > self.max_bytes and len(block) > 0:
+                    break
+                size += self.items[item][2]
+            block.append(item)
+        return tuple(block)
+
+    def stats(self):
+        """ Returns the depth of the pool, and the time items waited in it. """
+        return { "depth": len(self.items),
+                 "max_depth": self.max_depth,
+                 "admitted": self.admitted,
+                 "rejected": self.rejected,
+                 "removed": self.removed,
+                 "mean_wait": self.total_wait / self.removed if self.removed > 0 else None,
+                 "max_wait": self.max_wait }
@@ -1,6 +1,13 @@
+from hashlib import sha256
+
 from .types import *
 from .statemachine import dls_state_machine
 from .serialize import pack, unpack
+from .cache import dls_lru, dls_encoding_cache
+from .crypto import dls_hash_signer
+from .codec import frame, unframe, loads
+from .leaders import dls_leader_schedule
+from .mempool import dls_mempool
 
 dlsc = dls_state_machine
 
@@ -11,8 +18,13 @@ library deals with the actual message formats, signatures, and efficiencies. It
 the state machine. """
 
 from collections import namedtuple, defaultdict, Counter
+from bisect import bisect_right
+
+
+def payload_digest(block):
+    """ Returns the digest that addresses a block payload. """
+    return sha256(pack(block)).hexdigest()
 
-from hashlib import sha256
 
 class dls_net_peer():
 
@@ -22,8 +34,28 @@ class dls_net_peer():
     BLSACK = "BLSACK"
     BLSASK = "BLSASK"
     BLSPUT = "BLSPUT"
-
-    def __init__(self, my_id, priv, addrs, pubs, channel_id, start_r=0):
+    BLSFETCH = "BLSFETCH"
+    BLSPAYLOAD = "BLSPAYLOAD"
+    BLSBUSY = "BLSBUSY"
+    BLSBLOCKS = "BLSBLOCKS"
+
+    VERIFY_CACHE_SIZE = 4096
+
+    # Compact locks waiting for their evidence: at most one per sender and phase, the 
+    # oldest dropped first, and their evidence asked from all at most LOCK_FETCHES times.
+    MAX_PENDING_LOCKS = 64
+    LOCK_FETCHES = 4
+
+    # Subscribers get at most SUBSCRIBE_CREDIT blocks they did not acknowledge, in
+    # messages of at most SUBSCRIBE_BATCH blocks.
+    MAX_SUBSCRIBERS = 1024
+    SUBSCRIBE_CREDIT = 64
+    SUBSCRIBE_BATCH = 16
+
+    def __init__(self, my_id, priv, addrs, pubs, channel_id, start_r=0, 
+                 backup_f=None, wal_f=None, durability=None, store=None, window=None,
+                 signer=None, compact_evidence=False, payload_digests=False, eager=False,
+                 leader_health=False, pipeline=None, mempool=None):
         assert len(addrs) == len(pubs)
         self.N = len(addrs)
 
@@ -34,64 +66,198 @@ class dls_net_peer():
         self.addrs = addrs
         self.pubs = pubs
 
+        # The signature backend. Hash only signatures are only fit for tests.
+        self.signer = signer if signer is not None else dls_hash_signer()
+
         self.channel_id = channel_id
         self.round =  start_r
 
+        # Persistence of the state machine, shared by the state machines of all blocks.
+        self.backup_f = backup_f
+        self.wal_f = wal_f
+        self.durability = durability
+
+        # Decided blocks are appended to the store, if any, and then only a window
+        # of recent blocks and their decisions are kept in memory.
+        self.store = store
+        self.window = window
+
+        # In digest mode, the state machine runs on block digests, and the payloads are
+        # held by the sequence. Payloads are pushed once to each peer, and pulled from
+        # the sender of any message that references an unknown digest.
+        self.payload_digests = payload_digests
+        self.pushed = dls_lru(self.VERIFY_CACHE_SIZE) # (dest, digest)
+
+        # In eager mode, the state machine locks, acks and decides as soon as it can, and 
+        # decisions are announced as soon as they are reached.
+        self.eager = eager
+
+        # In pipelined mode, state machines run at once for a window of 'pipeline' 
+        # consecutive blocks, and blocks are committed in order as they are decided. Each
+        # block in the window then has its own backups: backup_f and wal_f hold one list 
+        # of files per slot of the window, and block bno uses slot bno % pipeline.
+        assert pipeline is None or pipeline >= 1
+        assert pipeline is None or all(f is None or len(f) == pipeline for f in (backup_f, wal_f))
+        self.pipeline = pipeline
+
+        # Experimental
+        self.seq = dls_sequence(store, window, mempool)
+
+        # With leader health, phases of leaders that recently failed go to others, as
+        # agreed in a decided block. Blocks of a pipeline take their schedule from the 
+        # block a pipeline before them, so that it is fixed before they start.
+        self.leaders = dls_leader_schedule(self.N, pipeline or 1) if leader_health else None
+        if self.leaders is not None:
+            for bno in range(max(0, self.seq.bno - (pipeline or 1)), self.seq.bno):
+                self.leaders.apply(bno, self.seq.get_block(bno))
+
         # Blocks
-        self.current_block_no = 0
-        self.sm = dls_state_machine((), self.i, self.N, self.round, self.package_raw)
+        self.current_block_no = self.seq.bno
+        self.sm = None
+        self.ahead = {} # bno -> state machine, of the blocks in progress after the current one
+        self.fill_pipeline()
+
+        # The decisions on the blocks in memory, starting with the certificates of those
+        # reloaded from the store.
         self.decisions = defaultdict(set)
+        for bno in range(self.seq.first_bno, self.seq.bno):
+            self.decisions[bno] = set(self.store.get(bno)[1])
 
         # Buffers.
         self.output = set()
 
-        # Experimental
-        self.seq = dls_sequence()
+        # Messages whose signature was already checked, and messages already given to 
+        # the state machine. Both are keyed by the full message, so that a forged message
+        # reusing a valid signature is never mistaken for the original.
+        self.verified = dls_lru(self.VERIFY_CACHE_SIZE)
+        self.encodings = dls_encoding_cache(self.VERIFY_CACHE_SIZE)
+        self.delivered = dls_lru(self.VERIFY_CACHE_SIZE)
+        self.dropped_duplicates = 0
+
+        # Proposals whose items were already scheduled, by digest, or by value. Proposals
+        # are sent again every phase, and only their first copy is merged.
+        self.merged = dls_lru(self.VERIFY_CACHE_SIZE)
+        self.skipped_merges = 0
+
+        # Subscribers to decided blocks: dest -> [ first block not acknowledged, first
+        # block not sent ]. The least recently subscribed are dropped first.
+        self.subscribers = dls_lru(self.MAX_SUBSCRIBERS)
+
+        # The latest phase seen from each peer, to catch up with rounds run faster elsewhere.
+        self.peer_phases = {}
+
+        # In compact mode, locks reference their BLSACCEPTABLE evidence by signature. The
+        # evidence store holds the verified BLSACCEPTABLE messages by signature, and locks
+        # missing some evidence wait for it to be fetched.
+        self.compact_evidence = compact_evidence
+        self.evidence = dls_lru(self.VERIFY_CACHE_SIZE)
+        self.pending_locks = dls_lru(self.MAX_PENDING_LOCKS) # (sender, bno, phase) -> [ lock, fetches ]
+
+    def signed_data(self, msg):
+        """ Returns the bytes covered by the signature of a message. """
+        return self.encodings.signed_data(msg)
+
+    def encode(self, msg):
+        """ Returns the bytes of a message on the wire, encoded only once. """
+        return self.encodings.encode(msg)
+
+    @staticmethod
+    def signed_messages(msgs):
+        """ Yields the signed messages, and the evidence they embed. """
+        stack = list(msgs)
+        while len(stack) > 0:
+            msg = stack.pop()
+            if type(msg) not in [BLSACCEPTABLE, BLSLOCK, BLSACK, BLSDECISION]:
+                continue
+            if type(msg) == BLSLOCK:
+                stack += msg.evidence
+            yield msg
 
     def pack_and_sign(self, msg):
-        # TODO: Use asymetric signatures
         assert type(msg) in [BLSACCEPTABLE, BLSLOCK, BLSACK, BLSDECISION]
         assert msg.signature == None
-        m2 = msg[:-1] 
-        bdata = sha256(pack(m2 + ( msg.sender, ))).hexdigest()
+        bdata = self.signer.sign(self.priv, self.signed_data(msg))
 
         m =  msg._make(msg[:-1] + (bdata,))
         assert self.check_sign(m)
         return m
 
     def check_sign(self, msg):
-        # TODO: Use asymetric signatures
         assert type(msg) in [BLSACCEPTABLE, BLSLOCK, BLSACK, BLSDECISION]
         assert msg.signature != None
-        bdata = sha256(pack(msg[:-1]  + ( msg.sender, ))).hexdigest()
-        return bdata == msg.signature
+        if msg.sender not in self.addrs:
+            return False
+        pub = self.pubs[self.addrs.index(msg.sender)]
+        return self.signer.verify(pub, self.signed_data(msg), msg.signature)
+
+    def verify_batch(self, msgs):
+        """ Checks at once the signatures of messages and their evidence, that are not 
+        already cached as verified. """
+        todo = set()
+        for msg in self.signed_messages(msgs):
+            if msg.signature is None or msg.sender not in self.addrs or msg in self.verified:
+                continue
+            todo.add(msg)
+
+        todo = list(todo)
+
+        if len(todo) == 0:
+            return
 
-    def package_raw(self, msg):
+        items = [ (self.pubs[self.addrs.index(msg.sender)], self.signed_data(msg), msg.signature)
+                  for msg in todo ]
+        for msg, ok in zip(todo, self.signer.verify_batch(items)):
+            if ok:
+                self.verified.put(msg, True)
+
+    def verify(self, msg):
+        """ Checks the signature of a message, unless it was already checked. """
+        if self.verified.get(msg) is not None:
+            return True
+
+        if not self.check_sign(msg):
+            return False
+
+        self.verified.put(msg, True)
+        return True
+
+    def package_raw(self, msg, bno=None):
         # If there is already a raw message, ignore.
         if msg.raw is not None:
             return msg
 
+        if bno is None:
+            bno = self.current_block_no
+
         assert msg.sender == self.i
         our_addr = self.addrs[self.i]
 
         if type(msg) == PHASE0:
             data = BLSACCEPTABLE(self.channel_id, self.BLSACCEPTABLE, our_addr, 
-                    self.current_block_no, msg.phase, msg.acceptable, None)
+                    bno, msg.phase, msg.acceptable, None)
 
             bls_msg = self.pack_and_sign(data)
             return PHASE0._make(msg[:-1] + ( bls_msg, ) )
 
         elif type(msg) == PHASE1LOCK:
-            eve = tuple(sorted(e.raw for e in msg.evidence))
+            if self.compact_evidence:
+                for e in msg.evidence:
+                    self.evidence.put(e.raw.signature, e.raw)
+                    # Our own acceptable message was never sent, so send it with the lock.
+                    if e.raw.sender == our_addr:
+                        self.output |= set( (r, e.raw) for r in self.all_others() )
+                eve = tuple(sorted(e.raw.signature for e in msg.evidence))
+            else:
+                eve = tuple(sorted(e.raw for e in msg.evidence))
             data = BLSLOCK( self.channel_id, self.BLSLOCK, our_addr, 
-                     self.current_block_no, msg.phase, msg.item, eve, None)
+                     bno, msg.phase, msg.item, eve, None)
             bls_msg = self.pack_and_sign(data)
             
             return PHASE1LOCK._make( msg[:-1] + (bls_msg, ) )
 
         elif type(msg) == PHASE2ACK:
             data = BLSACK( self.channel_id, self.BLSACK, our_addr, 
-                     self.current_block_no, msg.phase, msg.item, None)
+                     bno, msg.phase, msg.item, None)
             bls_msg = self.pack_and_sign(data)
 
             return PHASE2ACK._make( msg[:-1] + (bls_msg,) )
@@ -104,6 +270,47 @@ class dls_net_peer():
             raise Exception("Wrong type: %s" % type(msg))
 
 
+    def new_state_machine(self, proposal, bno=None):
+        if bno is None:
+            bno = self.current_block_no
+        if self.leaders is not None:
+            proposal = tuple(proposal) + ( self.leaders.health_entry(bno), )
+        if self.payload_digests:
+            proposal = self.seq.put_payload(proposal)
+        make_raw = lambda msg: self.package_raw(msg, bno)
+        backup_f, wal_f = self.backup_f, self.wal_f
+        if self.pipeline is not None:
+            backup_f = backup_f[bno % self.pipeline] if backup_f is not None else None
+            wal_f = wal_f[bno % self.pipeline] if wal_f is not None else None
+        return dls_state_machine(proposal, self.i, self.N, self.round, make_raw = make_raw,
+                                 backup_f = backup_f, wal_f = wal_f, 
+                                 durability = self.durability, eager = self.eager,
+                                 leaders = self.leaders.leaders(bno) if self.leaders is not None else None)
+
+    def fill_pipeline(self):
+        """ Starts the state machines of the blocks in the window that have none yet, 
+        each proposing a share of the items not already proposed for an earlier block. """
+        first = self.current_block_no
+        todo = [ bno for bno in range(first, first + (self.pipeline or 1))
+                 if (self.sm is None if bno == first else bno not in self.ahead) ]
+        for j, bno in enumerate(todo):
+            sm = self.new_state_machine(self.seq.new_block(bno, len(todo) - j), bno)
+            if bno == first:
+                self.sm = sm
+            else:
+                self.ahead[bno] = sm
+
+    def state_machines(self):
+        """ Returns the (bno, state machine) of the blocks in progress, in order. """
+        return [ (self.current_block_no, self.sm) ] + \
+               [ (bno, self.ahead[bno]) for bno in sorted(self.ahead) if bno > self.current_block_no ]
+
+    def get_state_machine(self, bno):
+        """ Returns the state machine of a block in progress, or None. """
+        if bno == self.current_block_no:
+            return self.sm
+        return self.ahead.get(bno) if bno > self.current_block_no else None
+
     def my_addr(self):
         """ Returns the address of the peer. """
         return self.addrs[self.i]
@@ -115,14 +322,58 @@ class dls_net_peer():
         return self.sm.get_leader(r) == self.i
 
 
+    def round_complete(self):
+        """ Returns whether the current round may end early, since all the messages it 
+        waits for are in, or the block is decided. """
+        if self.has_quorum() is not None:
+            return True
+        # Blocks later in the pipeline that are decided only wait to be committed.
+        return all(sm.round_complete() for bno, sm in self.state_machines()
+                   if bno == self.current_block_no or sm.get_decision() is None)
+
+    def sync_round(self):
+        """ Returns the first round of the latest phase that f+1 peers, so at least one 
+        correct peer, have reached, if it is ahead of ours. Otherwise None. """
+        phases = sorted(self.peer_phases.values(), reverse=True)
+        f = self.sm.faulty()
+        if len(phases) <= f:
+            return None
+
+        target = self.sm.get_first_round(phases[f])
+        return target if target > self.round else None
+
+    def is_archived(self, bno):
+        """ Returns whether a block is only held in the store. """
+        return self.store is not None and self.window is not None \
+                and bno < self.current_block_no - self.window
+
+    def load_certificate(self, bno):
+        """ Adds the certificate saved in the store to the decisions on a committed block, 
+        if those in memory are too few. """
+        if self.store is None or not (bno < self.current_block_no and bno in self.store) \
+                or len(self.decisions.get(bno, ())) >= self.N - self.sm.faulty():
+            return
+        known = { d.sender for d in self.decisions[bno] }
+        self.decisions[bno] |= set(d for d in self.store.get(bno)[1] if d.sender not in known)
+
     def build_decisions(self, bno):
+        if self.is_archived(bno):
+            return list(self.store.get(bno)[1])
+
+        sm = self.get_state_machine(bno)
         if bno < self.current_block_no:
             val = self.has_quorum(bno)
-        elif bno == self.current_block_no and self.sm.get_decision() != None:
-            val = self.sm.get_decision()
+        elif sm is not None and sm.get_decision() != None:
+            # Like the messages of the state machine, the decision goes out once durable.
+            sm.durability.barrier()
+            val = sm.get_decision()
         else:
             return []
 
+        # Never sign a decision without a decided value.
+        if val is None:
+            return []
+
         if self.my_addr() not in { dc.sender for dc in self.decisions[bno] }:
 
             d = BLSDECISION(channel = self.channel_id, 
@@ -139,24 +390,32 @@ class dls_net_peer():
         return list(self.decisions[bno])
 
     def insert_item(self, put_msg):
-        self.seq.put_item(put_msg.item)
+        """ Schedules the item of a BLSPUT, or tells its sender to back off if the pool
+        of pending items is full. """
+        if not self.seq.put_item(put_msg.item):
+            busy = BLSBUSY(self.channel_id, self.BLSBUSY, self.my_addr(), put_msg.item, 
+                           len(self.seq.to_be_sequenced))
+            self.output.add( (put_msg.sender, busy) )
 
 
     def decode_raw(self, msg):
         sender_id = self.addrs.index(msg.sender)
-        if not self.check_sign(msg):
+        if not self.verify(msg):
             return []
 
         if type(msg) == BLSDECISION:
 
             # Always save the decisions, and be ready to replay them.
-            if msg.sender not in { dc.sender for dc in self.decisions[msg.bno] }:
+            if self.is_archived(msg.bno):
+                pass
+            elif msg.sender not in { dc.sender for dc in self.decisions[msg.bno] }:
                 self.decisions[msg.bno].add(msg)
                 assert len(self.decisions[msg.bno]) <= self.N
 
-            if msg.bno == self.current_block_no:
+            sm = self.get_state_machine(msg.bno)
+            if sm is not None:
                 # Simulate both a decision and an ack.
-                phase = self.sm.get_phase_k(self.round)
+                phase = sm.get_phase_k(self.round)
                 sm_msg = PHASE0(dlsc.PHASE0, ( msg.block, ), phase, sender_id, raw=msg)
                 msg_ack = PHASE2ACK(dlsc.PHASE2ACK, msg.block, phase, sender_id, raw=msg)
 
@@ -169,8 +428,19 @@ class dls_net_peer():
 
         elif type(msg) == BLSLOCK:
 
+            missing = self.missing_evidence(msg)
+            if len(missing) > 0:
+                # Wait for the evidence, and ask the leader for it, once per lock.
+                key = (msg.sender, msg.bno, msg.phase)
+                if key not in self.pending_locks:
+                    self.pending_locks.put(key, [ msg, 0 ])
+                    self.fetch_evidence(missing, [ msg.sender ])
+                return []
+
             eve = []
             for e in msg.evidence:
+                if type(e) not in [BLSDECISION, BLSACCEPTABLE]:
+                    e = self.evidence.get(e)
                 if not(type(e) in [BLSDECISION, BLSACCEPTABLE] or self.check_sign(e)):
                     return []
                 outers = [m for m in self.decode_raw(e) if type(m) == PHASE0]
@@ -188,10 +458,71 @@ class dls_net_peer():
             return [ msg_ack ]
         assert False
 
+    def missing_evidence(self, lock):
+        """ Returns the signatures referenced by a compact lock that are not in the evidence store. """
+        return set(e for e in lock.evidence 
+                   if type(e) not in [BLSDECISION, BLSACCEPTABLE] and e not in self.evidence)
+
+    def fetch_evidence(self, digests, dests):
+        """ Asks peers for evidence, by signature, or for payloads, by digest. """
+        fetch = BLSFETCH(self.channel_id, self.BLSFETCH, self.my_addr(), 
+                         self.current_block_no, tuple(sorted(digests)))
+        for dest in dests:
+            if dest != self.my_addr():
+                self.output.add( (dest, fetch) )
+
+    def push_payloads(self, digests, dests):
+        """ Sends the payloads we hold for some digests, once to each peer. """
+        for d in digests:
+            block = self.seq.get_payload(d)
+            if block is None:
+                continue
+            for dest in dests:
+                if (dest, d) not in self.pushed:
+                    self.pushed.put((dest, d), True)
+                    self.output.add( (dest, BLSPAYLOAD(self.channel_id, self.BLSPAYLOAD, 
+                                                       self.my_addr(), d, block)) )
+
+    def pull_payloads(self, msg):
+        """ Asks the sender of a message for the payloads it references, that we lack. """
+        if type(msg) == BLSACCEPTABLE:
+            digests = msg.blocks
+        elif type(msg) in (BLSLOCK, BLSACK, BLSDECISION):
+            digests = ( msg.block, )
+        else:
+            return
+
+        missing = [ d for d in digests if d not in self.seq.payloads ]
+        if len(missing) > 0:
+            self.fetch_evidence(missing, [ msg.sender ])
+
+    def merge_proposal(self, key, block):
+        """ Schedules the items of a proposal, unless it was already merged. """
+        if key in self.merged:
+            self.skipped_merges += 1
+            return
+        self.merged.put(key, True)
+        self.seq.put_items(block)
+
+    def retry_pending_locks(self):
+        """ Processes the locks for which all evidence has now arrived. """
+        for key, (lock, _) in self.pending_locks.items():
+            if key not in self.pending_locks:
+                continue
+            elif self.get_state_machine(lock.bno) is None:
+                self.pending_locks.pop(key)
+            elif len(self.missing_evidence(lock)) == 0:
+                self.pending_locks.pop(key)
+                self.put_messages([ lock ])
+
     def has_quorum(self, bno=None):
         if bno == None:
             bno = self.current_block_no
-        
+
+        if self.is_archived(bno):
+            return self.store.get_block(bno)
+
+        self.load_certificate(bno)
         if bno not in self.decisions or len(self.decisions[bno]) == 0:
             return None
         
@@ -208,12 +539,66 @@ class dls_net_peer():
 
 
     # Internal functions for IO.
-    def put_messages(self, msgs):
+    def put_messages(self, msgs, verified=False):
+        """ Processes inbound messages. If 'verified' is set, their signatures (and those of 
+        their evidence) were already checked, for example by an ingest pipeline. """
+        msgs = list(msgs)
+        if verified:
+            for msg in self.signed_messages(msgs):
+                self.verified.put(msg, True)
+        else:
+            self.verify_batch(m for m in msgs if getattr(m, "channel", None) == self.channel_id)
 
         for msg in msgs:
-            assert type(msg) in [BLSPUT, BLSASK, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSDECISION]
+            assert type(msg) in [BLSPUT, BLSASK, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSDECISION, BLSFETCH,
+                                 BLSPAYLOAD, BLSBUSY, BLSSUBSCRIBE, BLSBLOCKS]
+
+            if msg.channel != self.channel_id or type(msg) in (BLSBUSY, BLSBLOCKS):
+                continue
+
+            if type(msg) == BLSSUBSCRIBE:
+                self.subscribe(msg.sender, msg.bno)
+                continue
 
-            if msg.channel != self.channel_id:
+            if type(msg) == BLSFETCH:
+                # Fetches are not signed, so drop those that do not hold digests.
+                if type(msg.digests) != tuple or not all(type(d) in (str, bytes) for d in msg.digests):
+                    continue
+
+                # Send back the evidence and payloads we hold.
+                for d in msg.digests[:self.N]:
+                    e = self.evidence.get(d)
+                    block = self.seq.get_payload(d)
+                    if e is not None:
+                        self.output.add( (msg.sender, e) )
+                    elif block is not None:
+                        self.output.add( (msg.sender, BLSPAYLOAD(self.channel_id, self.BLSPAYLOAD,
+                                                                 self.my_addr(), d, block)) )
+                continue
+
+            if type(msg) == BLSPAYLOAD:
+                # The sender holds the payload, so it need not be pushed to it.
+                self.pushed.put((msg.sender, msg.digest), True)
+
+                # Keep payloads that match their digest, and schedule their items.
+                if self.payload_digests and msg.digest not in self.seq.payloads \
+                        and payload_digest(msg.block) == msg.digest:
+                    self.seq.put_payload(msg.block)
+                    self.merge_proposal(msg.digest, msg.block)
+                continue
+
+            # Keep all valid acceptable messages and decisions, as evidence for compact locks.
+            if type(msg) in (BLSACCEPTABLE, BLSDECISION) and msg.signature not in self.evidence and self.verify(msg):
+                self.evidence.put(msg.signature, msg)
+
+            # Note the latest phase each peer has reached.
+            if type(msg) in (BLSACCEPTABLE, BLSLOCK, BLSACK) \
+                    and msg.phase > self.peer_phases.get(msg.sender, -1) and self.verify(msg):
+                self.peer_phases[msg.sender] = msg.phase
+
+            # Drop exact copies of messages already given to the state machine.
+            if type(msg) in (BLSACCEPTABLE, BLSLOCK, BLSACK) and msg in self.delivered:
+                self.dropped_duplicates += 1
                 continue
 
             if type(msg) == BLSPUT:
@@ -221,16 +606,21 @@ class dls_net_peer():
                 self.insert_item(msg)
                 continue
 
-            if type(msg) == BLSACCEPTABLE:
-                # Schedule the message for insertion in the next block.
-                for blck in msg.blocks:
-                    for m in blck:
-                        self.put_sequence(m)
+            if self.payload_digests and type(msg) in (BLSACCEPTABLE, BLSLOCK, BLSACK, BLSDECISION) \
+                    and self.verify(msg):
+                self.pull_payloads(msg)
 
-            # Process here messages for previous blocks.
-            bno = self.current_block_no
-            has_decision = msg.bno == bno and self.sm.get_decision() != None
-            has_decision |= (msg.bno < bno or msg.bno > bno)
+            if type(msg) == BLSACCEPTABLE and self.verify(msg):
+                # Schedule the items of the proposals for insertion in the next block.
+                for blck in msg.blocks:
+                    if not self.payload_digests:
+                        self.merge_proposal(blck, blck)
+                    elif blck in self.seq.payloads:
+                        self.merge_proposal(blck, self.seq.get_payload(blck))
+
+            # Process here messages for decided blocks, and blocks out of the window.
+            sm = self.get_state_machine(msg.bno)
+            has_decision = sm is None or sm.get_decision() != None
             if type(msg) in (BLSACCEPTABLE, BLSLOCK, BLSACK, BLSASK) and has_decision:
                 for d in self.build_decisions(msg.bno):
                     for resp in self.addrs:
@@ -241,8 +631,66 @@ class dls_net_peer():
         
             else:
                 in_msgs = self.decode_raw(msg)
-                self.sm.put_messages(in_msgs)
+                if sm is not None:
+                    sm.put_messages(in_msgs)
 
+                if type(msg) != BLSDECISION and len(in_msgs) > 0:
+                    self.delivered.put(msg, True)
+
+        if len(self.pending_locks) > 0:
+            self.retry_pending_locks()
+
+        if self.eager:
+            self.announce_decision()
+
+    def announce_decision(self):
+        """ Sends our decisions to all, as soon as the state machines reach them. """
+        for bno, sm in self.state_machines():
+            if sm.get_decision() is None or self.my_addr() in { d.sender for d in self.decisions[bno] }:
+                continue
+
+            for d in self.build_decisions(bno):
+                for dest in self.all_others():
+                    self.output.add( (dest, d) )
+
+
+    def subscribe(self, dest, bno):
+        """ Sends a subscriber the decided blocks from bno on, now and as they are committed.
+        Asking again for a later bno acknowledges the blocks before it, and for the same 
+        or an earlier one asks for them again. """
+        # Subscriptions come from clients, so bno is not trusted.
+        if type(bno) != int or bno < 0:
+            return
+        bno = max(bno, self.seq.first_bno if self.store is None else 0)
+
+        state = self.subscribers.get(dest)
+        if state is None or bno <= state[0]:
+            self.subscribers.put(dest, [ bno, bno ])
+        else:
+            self.subscribers.put(dest, [ bno, max(bno, state[1]) ])
+        self.push_blocks([ (dest, self.subscribers.get(dest)) ])
+
+    def push_blocks(self, subscribers=None):
+        """ Sends subscribers the committed blocks they lack, within their credit. """
+        if subscribers is None:
+            subscribers = self.subscribers.items()
+
+        for dest, state in subscribers:
+            end = min(self.current_block_no, state[0] + self.SUBSCRIBE_CREDIT)
+            for start in range(state[1], end, self.SUBSCRIBE_BATCH):
+                bnos = range(start, min(end, start + self.SUBSCRIBE_BATCH))
+                msg = BLSBLOCKS(self.channel_id, self.BLSBLOCKS, self.my_addr(), start,
+                                tuple(self.seq.get_block(b) for b in bnos),
+                                tuple(tuple(self.certificate(b)) for b in bnos))
+                self.output.add( (dest, msg) )
+            state[1] = max(state[1], end)
+
+    def certificate(self, bno):
+        """ Returns the BLSDECISION messages of N-f peers on a committed block. """
+        if self.is_archived(bno):
+            return list(self.store.get(bno)[1])
+        decision = self.has_quorum(bno)
+        return sorted((d for d in self.decisions[bno] if d.block == decision), key=lambda d: d.sender)
 
     def all_others(self):
         all_receivers = self.addrs[:]
@@ -251,69 +699,195 @@ class dls_net_peer():
 
 
     def get_messages(self):
-        buf_out = self.sm.get_messages()
-
         all_receivers = self.all_others()
-        if self.i_am_leader():
-            receivers = all_receivers
-        else:
-            leader = self.sm.get_leader(self.round)
-            receivers = [ self.addrs[leader] ] 
 
-        for msg in buf_out:
-            self.output |= set( (r, msg.raw) for r in receivers)
-
-        out = list(self.output)
+        # Each block in the pipeline has its own leader schedule.
+        for _, sm in self.state_machines():
+            leader = sm.get_leader(self.round)
+            receivers = all_receivers if leader == self.i else [ self.addrs[leader] ]
+
+            for msg in sm.get_messages():
+                if self.payload_digests and type(msg) == PHASE0:
+                    self.push_payloads(msg.acceptable, all_receivers)
+
+                # Compact locks only reference their evidence, so all peers need it beforehand.
+                # In eager mode, all peers decide on the acks.
+                if (self.compact_evidence and type(msg) == PHASE0) or (self.eager and type(msg) == PHASE2ACK):
+                    self.output |= set( (r, msg.raw) for r in all_receivers)
+                else:
+                    self.output |= set( (r, msg.raw) for r in receivers)
+
+        # Committed blocks are durable before they are announced.
+        if self.store is not None:
+            self.store.durability.barrier()
+
+        # Payloads go out ahead of the messages that reference them, and blocks to 
+        # subscribers in order.
+        out = sorted(self.output, key=lambda x: (type(x[1]) != BLSPAYLOAD,
+                                                 x[1].bno if type(x[1]) == BLSBLOCKS else -1))
         self.output.clear()
         assert len(self.output) == 0
 
         return out
 
-    def advance_round(self, set_round = None):
-        if self.has_quorum() == None:
-            # No decision reached, continue the protocol.
-            # But always include previous decisions in the processing.
-            self.put_messages(self.decisions[self.current_block_no])
+    def get_batches(self):
+        """ Like get_messages, but returns the messages grouped by destination. """
+        batches = defaultdict(list)
+        for (dest, msg) in self.get_messages():
+            batches[dest].append(msg)
+        return dict(batches)
+
+    def get_envelopes(self, compress=False):
+        """ Returns one framed envelope per destination, holding all messages to it. Each 
+        message is encoded once, however many envelopes it is in. """
+        return [ (dest, frame([ self.encode(msg) for msg in msgs ], compress))
+                 for dest, msgs in self.get_batches().items() ]
+
+    def put_envelope(self, data):
+        """ Processes the messages in an envelope from get_envelopes. """
+        self.put_messages([ loads(d) for d in unframe(data) ])
+
+    def get_encoded_messages(self):
+        """ Like get_messages, but returns (dest, bytes) pairs. Each message is encoded once,
+        however many receivers it has. """
+        return [ (dest, self.encode(msg)) for (dest, msg) in self.get_messages() ]
+
+    def decided_block(self):
+        """ Returns the decided value of the current block, once it can be committed. """
+        decision = self.has_quorum()
+        if decision is not None and self.payload_digests and decision not in self.seq.payloads:
+            # The digest is decided, but the block cannot end before its payload arrives.
+            self.fetch_evidence([ decision ], self.all_others())
+            decision = None
+        return decision
+
+    def commit_block(self, decision):
+        """ Commits the current block, and starts the next. """
+        block = self.seq.get_payload(decision) if self.payload_digests else decision
+
+        # register our own decision.
+        D = self.build_decisions(self.current_block_no)
+
+        for d in D:
+            for dest in self.all_others():
+                self.output.add( (dest, d) )
+
+        # Save the block with its certificate, before it leaves memory.
+        if self.store is not None:
+            bno = self.current_block_no
+            cert = [ d for d in self.decisions[bno] if d.block == decision ]
+            self.store.append(bno, block, cert)
 
-        else:
-            # Decision reached, start the new block
-            decision = self.has_quorum()
-            self.seq.set_block(self.current_block_no, decision)
+        self.seq.set_block(self.current_block_no, block)
+        if self.leaders is not None:
+            self.leaders.apply(self.current_block_no, block)
 
-            ## TODO: Possibly reconfigure the shard here.
+        ## TODO: Possibly reconfigure the shard here.
 
-            # register our own decision.
-            all_receivers = self.all_others()
-            D = self.build_decisions(self.current_block_no)
+        # Start new block
+        self.current_block_no += 1
 
-            for d in D:
-                for dest in self.all_others():
-                    self.output.add( (dest, d) )
+        if self.window is not None and self.store is not None:
+            for old in [ bno for bno in self.decisions if self.is_archived(bno) ]:
+                del self.decisions[old]
 
-            # Start new block
-            self.current_block_no += 1
+        self.sm = self.ahead.pop(self.current_block_no, None)
 
-            proposal0 = self.seq.new_block(self.current_block_no)
-            self.sm = dls_state_machine(proposal0, self.i, self.N, self.round, make_raw = self.package_raw)
+    def advance_round(self, set_round = None):
+        # Commit the decided blocks in order, up to a window of them.
+        committed = 0
+        while committed < (self.pipeline or 1):
+            decision = self.decided_block()
+            if decision is None:
+                break
+            self.commit_block(decision)
+            committed += 1
+        self.fill_pipeline()
+
+        if committed > 0 and len(self.subscribers) > 0:
+            self.push_blocks()
+
+        if committed == 0:
+            # No decision reached, continue the protocol.
+            # But always include previous decisions in the processing.
+            for bno, _ in self.state_machines():
+                self.put_messages(self.decisions[bno])
 
+            # Ask everyone for evidence still missing, a few times.
+            for _, pending in self.pending_locks.items():
+                if pending[1] < self.LOCK_FETCHES:
+                    pending[1] += 1
+                    self.fetch_evidence(self.missing_evidence(pending[0]), self.all_others())
 
         # Make a step
+        old_round = self.round
         if set_round is not None and set_round > self.round:
             self.round = set_round
         else:
             self.round += 1
-        self.sm.process_round(set_round = self.round)
+        for _, sm in self.state_machines():
+            sm.process_round(set_round = self.round)
+
+        # Note whether the leader of the phase was heard from. Leaders that are up, but 
+        # find no item to lock on, are not failed.
+        k = self.sm.get_phase_k(old_round)
+        if self.leaders is not None and self.sm.get_round_type(old_round) == 2:
+            leader = self.sm.get_leader_phase(k)
+            alive = leader == self.i or self.peer_phases.get(self.addrs[leader], -1) >= k
+            self.leaders.observe(leader, alive)
+
+        if self.eager:
+            self.announce_decision()
 
     # External functions for sequencing.
 
     def put_sequence(self, item):
-        """ Schedules an item to be sequenced. """
-        self.seq.put_item(item)
+        """ Schedules an item to be sequenced. Returns False if the pool of pending items
+        is full, and the item was refused. """
+        return self.seq.put_item(item)
 
     def get_sequence(self):
         """ Get the sequence of all items that are decided. """
         return list(self.seq.get_sequence())
 
+    def iter_sequence(self, offset=0):
+        """ Yields the decided items from the one at 'offset' on, without building the
+        whole sequence. """
+        return self.seq.get_sequence(offset)
+
+    def get_commit(self, item):
+        """ Returns where an item was committed, as (bno, position in the block, certificate),
+        where the certificate holds the BLSDECISION messages of N-f peers for the block. 
+        Returns None if the item is not committed. """
+        where = self.seq.index.get(item)
+        if where is None:
+            return None
+
+        bno, pos = where
+        return (bno, pos, self.certificate(bno))
+
+
+
+class dls_item_map(dict):
+    """ The item index of a sequence without a store, in memory, with the same interface
+    as the one of a store (see blockstore.py). """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.blocks = 0
+        self.length = 0
+        self.starts = []
+
+    def start(self, bno):
+        return self.starts[bno] if bno < self.blocks else self.length
+
+    def add(self, bno, items):
+        assert bno == self.blocks
+        self.starts.append(self.length)
+        for pos, item in items:
+            self[item] = (bno, pos)
+        self.length += len(items)
+        self.blocks += 1
 
 
 class dls_sequence():
@@ -321,23 +895,102 @@ class dls_sequence():
     Despite containing a lot of state this instance is not critical, 
     and all state should be re-buildable from the list of decisions held by the peer."""
 
-    def __init__(self):
+    PAYLOAD_CACHE_SIZE = 4096
+
+    def __init__(self, store=None, window=None, mempool=None):
         # Messages to be sequenced.
 
         self.bno = 0
-        self.to_be_sequenced = set()
-        self.sequence = set()
+        self.to_be_sequenced = mempool if mempool is not None else dls_mempool()
+
+        # Where each committed item is: its block number and position in the block. Also,
+        # the offset in the sequence of the first item of each block, and the length of
+        # the sequence. With a store, the index is kept on disk next to it.
+        self.index = store.items if store is not None else dls_item_map()
+        self.sequence = self.index if store is not None else self.index.keys()
+        self.proposed = {} # item -> bno of the block in progress we proposed it for
 
         self.old_blocks = []
 
-    def get_sequence(self):
-        for b in self.old_blocks:
-            for item in b:
+        # With a store, only a window of recent blocks is kept in memory,
+        # and first_bno is the number of the first of them.
+        self.store = store
+        self.window = window
+        self.first_bno = 0
+
+        # Block payloads, by digest.
+        self.payloads = dls_lru(self.PAYLOAD_CACHE_SIZE)
+
+        if store is not None:
+            self.bno = len(store)
+            self.first_bno = max(0, self.bno - window) if window is not None else 0
+            # Blocks stored just before a crash may not be indexed yet.
+            for bno in range(self.index.blocks, self.bno):
+                self.index_block(bno, store.get_block(bno))
+            self.old_blocks = [ store.get_block(bno) for bno in range(self.first_bno, self.bno) ]
+
+    @property
+    def length(self):
+        return self.index.length
+
+    def index_block(self, bno, block):
+        # Blocks decided in a pipeline may repeat items of the blocks before them, 
+        # and only the first occurrence of an item counts.
+        new = {}
+        for pos, item in enumerate(block):
+            if type(item) != BLSHEALTH and item not in new and item not in self.index:
+                new[item] = pos
+        self.index.add(bno, [ (pos, item) for item, pos in new.items() ])
+
+    def get_block(self, bno):
+        """ Returns a decided block, from memory or from the store. """
+        if bno < self.first_bno:
+            return self.store.get_block(bno)
+        return self.old_blocks[bno - self.first_bno]
+
+    def get_sequence(self, offset=0):
+        """ Yields the decided items in order, from the one at 'offset' on. Blocks are
+        read as the items are consumed. """
+        if offset >= self.length:
+            return
+
+        first = bisect_right(range(self.index.blocks), offset, key=self.index.start) - 1
+        skip = offset - self.index.start(first)
+        for bno in range(first, self.index.blocks):
+            for pos, item in enumerate(self.get_block(bno)):
+                if type(item) == BLSHEALTH or self.index.get(item) != (bno, pos):
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    continue
                 yield item
 
+    def put_payload(self, block):
+        """ Stores a block payload, and returns its digest. """
+        d = payload_digest(block)
+        self.payloads.put(d, block)
+        return d
+
+    def get_payload(self, digest):
+        return self.payloads.get(digest)
+
     def put_item(self, item):
-        if item not in self.sequence and item not in self.to_be_sequenced:
-            self.to_be_sequenced.add( item )
+        """ Schedules an item, and returns False if the pool is full. """
+        # Block entries that are not items are never sequenced on their own.
+        if type(item) == BLSHEALTH or item in self.sequence:
+            return True
+        return self.to_be_sequenced.add( item )
+
+    def put_items(self, items):
+        """ Schedules the items of a proposal at once, and returns False if the pool 
+        refused any. Only the items not already known are looked at one by one. """
+        new = frozenset(items).difference(self.to_be_sequenced.items)
+        ok = True
+        if len(new) > 0:
+            for item in items:
+                if item in new and item not in self.sequence:
+                    ok &= self.put_item(item)
+        return ok
 
     def check_block(self, bno, block):
         if bno != self.bno:
@@ -350,14 +1003,29 @@ class dls_sequence():
         
     def set_block(self, bno, block):
         if bno != self.bno:
-            raise Exception("Wrong block number, next is %s" % len(self.old_blocks))
+            raise Exception("Wrong block number, next is %s" % self.bno)
 
-        self.sequence |= set(block)
-        self.to_be_sequenced = set(item for item in self.to_be_sequenced if item not in block)
+        self.index_block(bno, block)
+        self.to_be_sequenced.remove_all(block)
+        # Items proposed for this block, but not decided in it, may be proposed again.
+        self.proposed = { item: b for item, b in self.proposed.items() 
+                          if b > bno and item in self.to_be_sequenced }
         self.bno += 1
         self.old_blocks += [ block ]
 
-    def new_block(self, bno):
-        block = tuple(self.to_be_sequenced)
-        assert self.check_block(bno, block)
+        # Older blocks are served from the store.
+        if self.store is not None and self.window is not None and len(self.old_blocks) > self.window:
+            excess = len(self.old_blocks) - self.window
+            del self.old_blocks[:excess]
+            self.first_bno += excess
+
+    def new_block(self, bno, parts=1):
+        """ Returns a proposal for block bno, of the items not already proposed for an 
+        earlier block still in progress, or one in 'parts' of them, to share them among
+        blocks proposed at once. The pool caps the size of the block. """
+        available = max(0, len(self.to_be_sequenced) - len(self.proposed))
+        block = self.to_be_sequenced.take(self.proposed, -(-available // parts))
+        assert bno >= self.bno and all(item not in self.sequence for item in block)
+        for item in block:
+            self.proposed[item] = bno
         return block
@@ -0,0 +1,147 @@
+""" Persistence helpers for the state machine: snapshot headers, record framing for
+the write-ahead log, and the durability policy. Each log record is length prefixed and followed
+by a truncated digest, so that a torn write at the end of a log is detected and
+ignored on replay. """
+
+import os
+import struct
+from hashlib import sha256
+from threading import RLock
+from concurrent.futures import ThreadPoolExecutor
+
+RECORD_HEADER = struct.Struct(">I")
+DIGEST_SIZE = 16
+
+# Snapshots start with a fixed size header: round, length and digest of the body.
+SNAPSHOT_HEADER = struct.Struct(">qI%ss" % DIGEST_SIZE)
+
+
+def digest(bindata):
+    return sha256(bindata).digest()[:DIGEST_SIZE]
+
+
+def file_size(f1):
+    f1.seek(0, 2)
+    return f1.tell()
+
+
+def snapshot_encode(xround, bindata):
+    """ Returns a snapshot with its header. """
+    return SNAPSHOT_HEADER.pack(xround, len(bindata), digest(bindata)) + bindata
+
+
+def snapshot_header(f1):
+    """ Reads the (round, length, digest) header of a snapshot, or None. """
+    f1.seek(0)
+    raw = f1.read(SNAPSHOT_HEADER.size)
+    if len(raw) != SNAPSHOT_HEADER.size:
+        return None
+    return SNAPSHOT_HEADER.unpack(raw)
+
+
+def snapshot_read(f1, header):
+    """ Reads the body of a snapshot, and checks it against its header. """
+    _, size, checksum = header
+    f1.seek(SNAPSHOT_HEADER.size)
+    bindata = f1.read(size)
+    if len(bindata) != size or digest(bindata) != checksum:
+        raise Exception("Digest mismatch")
+    return bindata
+
+
+def wal_append(f1, bindata):
+    """ Appends a record to the end of a log file. """
+    f1.seek(0, 2)
+    f1.write(RECORD_HEADER.pack(len(bindata)) + bindata + digest(bindata))
+
+
+def wal_records(f1):
+    """ Yields the records of a log file, up to the first one that is broken. """
+    f1.seek(0)
+    raw = f1.read()
+
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(raw):
+        (size, ) = RECORD_HEADER.unpack_from(raw, pos)
+        start = pos + RECORD_HEADER.size
+        end = start + size
+
+        if end + DIGEST_SIZE > len(raw):
+            break
+
+        bindata = raw[start:end]
+        if digest(bindata) != raw[end:end + DIGEST_SIZE]:
+            break
+
+        yield bindata
+        pos = end + DIGEST_SIZE
+
+
+def wal_reset(f1):
+    """ Empties a log file, once its records are part of a snapshot. """
+    f1.seek(0)
+    f1.truncate()
+
+
+class dls_durability():
+    """ A policy for when persisted state is made durable. Files written by
+    persist are only flushed (and synced to disk, if fsync is set) every
+    'sync_every' persists, or when sync_every is None only before messages
+    are released. A single policy can be shared by several state machines,
+    so that their files are synced together in one group commit. """
+
+    def __init__(self, fsync=False, sync_every=1, workers=1):
+        self.fsync = fsync
+        self.sync_every = sync_every
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+
+        self.lock = RLock()
+        self.dirty = {}  # id(file) -> file, written since the last sync.
+        self.pending = 0 # persists since the last sync.
+
+        # Metrics
+        self.syncs = 0
+        self.synced_files = 0
+
+    def _run(self, op, files):
+        if self.pool is not None and len(files) > 1:
+            list(self.pool.map(op, files))
+        else:
+            for f1 in files:
+                op(f1)
+
+    def write(self, files, op):
+        """ Applies a write operation to the redundant files, in parallel if there are workers. """
+        self._run(op, files)
+        with self.lock:
+            for f1 in files:
+                self.dirty[id(f1)] = f1
+
+    def commit(self):
+        """ Marks the end of a persist, and syncs if the batch is complete. """
+        with self.lock:
+            self.pending += 1
+            if self.sync_every is not None and self.pending >= self.sync_every:
+                self.sync()
+
+    def barrier(self):
+        """ Makes all written state durable, before messages are released. """
+        with self.lock:
+            if len(self.dirty) > 0:
+                self.sync()
+
+    def sync(self):
+        with self.lock:
+            files = list(self.dirty.values())
+            self.dirty.clear()
+            self.pending = 0
+
+            if len(files) > 0:
+                self._run(self._sync_one, files)
+                self.syncs += 1
+                self.synced_files += len(files)
+
+    def _sync_one(self, f1):
+        f1.flush()
+        if self.fsync:
+            os.fsync(f1.fileno())
@@ -0,0 +1,77 @@
+""" Incremental vote counting. Senders are kept as integer bitmasks per (phase, item),
+so that counting a vote is a couple of integer operations, and a callback fires
+as soon as an item gathers a quorum of votes. """
+
+
+def bitcount(mask):
+    """ Returns the number of senders in a bitmask. """
+    return bin(mask).count("1")
+
+
+def senders_of(mask):
+    """ Returns the set of senders in a bitmask. """
+    return set(i for i in range(mask.bit_length()) if (mask >> i) & 1)
+
+
+class dls_tally():
+    """ Counts the distinct senders voting for items, per phase. """
+
+    def __init__(self, threshold=None, on_quorum=None):
+        self.threshold = threshold
+        self.on_quorum = on_quorum
+        self.phases = {} # phase -> item -> [ mask, count, messages ]
+
+    def vote(self, phase, item, sender, msg=None):
+        """ Counts a vote, and returns whether it completed a quorum for the item. """
+        by_item = self.phases.setdefault(phase, {})
+        entry = by_item.get(item)
+        if entry is None:
+            entry = by_item[item] = [0, 0, set()]
+
+        if msg is not None:
+            entry[2].add(msg)
+
+        bit = 1 << sender
+        if entry[0] & bit:
+            return False
+
+        entry[0] |= bit
+        entry[1] += 1
+
+        if self.threshold is not None and entry[1] == self.threshold:
+            if self.on_quorum is not None:
+                self.on_quorum(phase, item)
+            return True
+        return False
+
+    def count(self, phase, item):
+        """ Returns the number of distinct senders voting for the item. """
+        entry = self.phases.get(phase, {}).get(item)
+        return entry[1] if entry is not None else 0
+
+    def mask(self, phase, item):
+        entry = self.phases.get(phase, {}).get(item)
+        return entry[0] if entry is not None else 0
+
+    def senders(self, phase, item):
+        return senders_of(self.mask(phase, item))
+
+    def evidence(self, phase, item):
+        """ Returns the messages that voted for the item. """
+        entry = self.phases.get(phase, {}).get(item)
+        return entry[2] if entry is not None else set()
+
+    def items(self, phase):
+        """ Returns all items with at least one vote in a phase. """
+        return self.phases.get(phase, {}).keys()
+
+    def quorums(self, phase):
+        """ Returns the items with a quorum of votes in a phase. """
+        if self.threshold is None:
+            return []
+        return [ item for item, entry in self.phases.get(phase, {}).items()
+                 if entry[1] >= self.threshold ]
+
+    def drop_before(self, phase):
+        for old in [p for p in self.phases if p < phase]:
+            del self.phases[old]
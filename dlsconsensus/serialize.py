@@ -3,7 +3,7 @@ from .types import *
 
 import msgpack
 
-xtypes = [tuple, set, PHASE0, PHASE1LOCK, PHASE2ACK, RELEASE3, BLSDECISION, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSASK, BLSPUT]
+xtypes = [tuple, set, PHASE0, PHASE1LOCK, PHASE2ACK, RELEASE3, BLSDECISION, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSASK, BLSPUT, BLSFETCH, BLSPAYLOAD, BLSHEALTH, BLSBUSY, BLSSUBSCRIBE, BLSBLOCKS]
 xmap = dict((k, i) for i, k in enumerate(xtypes))
 
 def ext_pack(x):
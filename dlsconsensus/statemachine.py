@@ -1,7 +1,12 @@
-from hashlib import sha256
+from threading import Thread
 
 from .types import *
 from .serialize import pack, unpack
+from .buffer import dls_buffer
+from .quorum import bitcount
+from .cache import dls_lru
+from .persist import wal_append, wal_records, wal_reset, dls_durability
+from .persist import snapshot_encode, snapshot_header, snapshot_read, file_size, digest
 
 valid_messages = set([ PHASE0, PHASE1LOCK, PHASE2ACK, RELEASE3 ])
 
@@ -14,7 +19,11 @@ class dls_state_machine():
     PHASE2ACK = "PHASE2ACK"
     RELEASE3 = "RELEASE3"
 
-    def __init__(self, my_vi, my_id, N, start_r = 0, make_raw = None, backup_f = None):
+    LOCK_CACHE_SIZE = 1024
+    WAL_COMPACT_EVERY = 64
+
+    def __init__(self, my_vi, my_id, N, start_r = 0, make_raw = None, backup_f = None, wal_f = None,
+                 durability = None, eager = False, leaders = None):
         """ Initialize with an own value, own id and the number of peers. """
         assert 0 <= my_id < N 
 
@@ -28,76 +37,245 @@ class dls_state_machine():
         self.decision = None
 
         # In and out buffers for network IO.
-        self.buf_in = set()
+        self.buf_in = dls_buffer(threshold=self.N - self.faulty(), on_quorum=self.on_quorum)
         self.buf_out = set()
 
         self._trace = False
         self.make_raw = make_raw if make_raw != None else lambda x: x
         self.backup_f = backup_f
 
+        # In write-ahead log mode, only the changes since the last persist are
+        # appended to the logs, and snapshots are written to backup_f periodically.
+        self.wal_f = wal_f
+        self._persisted_locks = None
+        self._snapshot = None # Digest of the snapshot the logs extend.
+        self._new_seen = []
+        self._wal_records = 0
+
+        # Persisted state restarts from the last round processed, which is then run again,
+        # even when it is persisted on the arrival of messages for the next one.
+        self._restart_round = start_r
+
+        # Decides when the written state is made durable.
+        self.durability = durability if durability is not None else dls_durability()
+        self._repair = None
+
+        # Locks are immutable, so their validity is only checked once.
+        self.lock_cache = dls_lru(self.LOCK_CACHE_SIZE)
+
+        # In eager mode, the leader locks as soon as it has a quorum of acceptable items,
+        # peers ack locks on arrival, and any peer decides on a quorum of acks. Peers
+        # then have to send their acks to all. The locks sent and the items acked are 
+        # remembered, so that rounds do not repeat them.
+        self.eager = eager
+        self._lock_phases = set()
+        self._acked = set() # (phase, item)
+
+        # Maps phases to leaders, by default in a fixed rotation.
+        self.leaders = leaders
+
     def faulty(self):
         return (self.N - 1) // 3
 
     @staticmethod
-    def from_recovery(start_r = 0, make_raw = None, backup_f = None):
-        sm = dls_state_machine((), 0, 4, start_r, make_raw, backup_f)
-        sm.recover()
+    def from_recovery(start_r = 0, make_raw = None, backup_f = None, wal_f = None, durability = None):
+        """ Builds a state machine from its backups, of any committee size. """
+        if backup_f is None:
+            raise Exception("No backup files available.")
+
+        winner, data, stale = dls_state_machine.read_backups(backup_f, wal_f)
+        i, vi, N = data[:3]
+
+        sm = dls_state_machine(vi, i, N, start_r, make_raw, backup_f, wal_f, durability)
+        sm.restore(data)
+        sm.repair_backups(winner, stale)
         return sm
-        
+
     def persist(self):
-        data = (self.i, self.vi, self.N, self.all_seen, self.round, self.locks, self.decision)
-        
+        """ Saves the state, as a delta in the logs if possible or else as a snapshot. """
+        self.wait_repair()
+
+        if self.wal_f is not None and self._persisted_locks is not None \
+                and self._wal_records < self.WAL_COMPACT_EVERY:
+            self.persist_delta()
+        else:
+            self.persist_snapshot()
+        self.durability.commit()
+
+    def persist_delta(self):
+        old_locks = self._persisted_locks
+        set_locks = tuple((k, v) for k, v in self.locks.items() if old_locks.get(k) is not v)
+        del_locks = tuple(k for k in old_locks if k not in self.locks)
+
+        delta = (self._snapshot, self._restart_round, self.decision, tuple(self._new_seen), 
+                 set_locks, del_locks)
+        bindata = pack(delta)
+
+        if self._trace:
+            print("Persist delta %s bytes" % len(bindata))
+
+        self.durability.write(self.wal_f, lambda f1: wal_append(f1, bindata))
+
+        self._persisted_locks = dict(self.locks)
+        self._new_seen = []
+        self._wal_records += 1
+
+    def persist_snapshot(self):
+        # Locks are saved as (item, lock) pairs, since items, like blocks, may not be map keys.
+        data = (self.i, self.vi, self.N, self.all_seen, self._restart_round, tuple(self.locks.items()), 
+                self.decision)
         bindata = pack(data)
-        binhash = sha256(bindata).digest()[:16]
+        snapshot = snapshot_encode(self._restart_round, bindata)
 
         if self._trace:
-            print("Persist %s bytes" % len(bindata + binhash))
+            print("Persist %s bytes" % len(snapshot))
 
         if self.backup_f is not None:
-            for f1 in self.backup_f:
+            def write_snapshot(f1):
                 f1.seek(0)
-                f1.write(bindata + binhash)
+                f1.write(snapshot)
                 f1.truncate()
-                f1.flush()
+
+            self.durability.write(self.backup_f, write_snapshot)
 
             if __debug__:
-                data2 = self.recover_from_f(f1)
+                data2 = self.recover_from_f(self.backup_f[-1])
 
-    def recover_from_f(self, f1):
-        f1.seek(0)
-        raw = f1.read()
-        bindata = raw[:-16]
-        binhash = raw[-16:]
-        if sha256(bindata).digest()[:16] != binhash:
-            raise Excpetion("Digest mismatch")
+        # The logs only hold changes since the snapshot, so they are now empty.
+        # The snapshot must be durable before they are, and records left over from
+        # a crash in between are told apart by the snapshot they extend.
+        if self.wal_f is not None:
+            self.durability.sync()
+            self.durability.write(self.wal_f, wal_reset)
+            self._snapshot = digest(bindata)
 
-        data = unpack(bindata)
-        return data
+            self._persisted_locks = dict(self.locks)
+            self._new_seen = []
+            self._wal_records = 0
 
-    def recover(self, just_check = False):
-        if self.backup_f is None:
-            raise Exception("No backup files available.")
+    @staticmethod
+    def decode_state(bindata):
+        i, vi, N, all_seen, xround, locks, decision = unpack(bindata)
+        return (i, vi, N, all_seen, xround, dict(locks), decision)
+
+    @staticmethod
+    def recover_from_f(f1):
+        header = snapshot_header(f1)
+        if header is None:
+            raise Exception("Missing header")
+        return dls_state_machine.decode_state(snapshot_read(f1, header))
 
-        errors = False
+    @staticmethod
+    def replay_wal(data, f1, snapshot):
+        """ Applies the deltas in a log to the state recovered from a snapshot, with the
+        digest 'snapshot'. Deltas written before the snapshot are skipped. """
+        i, vi, N, all_seen, xround, locks, decision = data
+        for bindata in wal_records(f1):
+            base, xround2, decision2, new_seen, set_locks, del_locks = unpack(bindata)
+            if base != snapshot:
+                continue
+            xround, decision = xround2, decision2
+            all_seen.update(new_seen)
+            locks.update(set_locks)
+            for item in del_locks:
+                locks.pop(item, None)
+
+        return (i, vi, N, all_seen, xround, locks, decision)
 
-        recovered = []
-        for f1 in self.backup_f:
+    @staticmethod
+    def read_backups(backup_f, wal_f = None):
+        """ Returns the index of the latest backup, its state, and the indexes of the stale 
+        or broken backups. Only the headers are read, and then the latest backup is decoded. """
+        headers = []
+        for f1 in backup_f:
             try:
-                data = self.recover_from_f(f1)
-                recovered += [(data[4], data)]
-            except:
-                errors = True            
-             
-        if len(recovered) == 0:
-            raise Exception("All backups failed.")
+                headers += [ snapshot_header(f1) ]
+            except Exception:
+                headers += [ None ]
 
-        # Take the higher round backup
-        data = max(recovered)[1]
+        # Try the backups from the highest round down, until one decodes.
+        order = sorted(((h[0], j) for j, h in enumerate(headers) if h is not None), reverse=True)
+        for _, j in order:
+            try:
+                data = dls_state_machine.decode_state(snapshot_read(backup_f[j], headers[j]))
+                if wal_f is not None:
+                    data = dls_state_machine.replay_wal(data, wal_f[j], headers[j][2])
+            except Exception:
+                continue
+
+            stale = [ k for k, h in enumerate(headers) if h != headers[j] ]
+            if wal_f is not None:
+                size = file_size(wal_f[j])
+                stale += [ k for k in range(len(wal_f)) if k not in stale and file_size(wal_f[k]) != size ]
+
+            return j, data, stale
+
+        raise Exception("All backups failed.")
+
+    def restore(self, data):
+        """ Assigns a recovered state. """
+        self.i, self.vi, self.N, self.all_seen, \
+            self.round, self.locks, self.decision = data
+        self.buf_in.set_threshold(self.N - self.faulty())
+        self._restart_round = self.round
+
+        # Start the logs afresh from a snapshot of the recovered state.
+        self._persisted_locks = None
+
+    def repair_backups(self, winner, stale):
+        """ Checks the other backups in the background, and overwrites those that are 
+        stale or broken with the latest one. """
+        if len(self.backup_f) < 2:
+            return
+
+        def is_broken(k):
+            if k in stale:
+                return True
+            try:
+                header = snapshot_header(self.backup_f[k])
+                snapshot_read(self.backup_f[k], header)
+                return False
+            except Exception:
+                return True
+
+        def copy(files, broken):
+            src = files[winner]
+            src.seek(0)
+            raw = src.read()
+
+            def write(f1):
+                f1.seek(0)
+                f1.write(raw)
+                f1.truncate()
+            self.durability.write([ files[k] for k in broken ], write)
+
+        def repair():
+            broken = [ k for k in range(len(self.backup_f)) if k != winner and is_broken(k) ]
+            if len(broken) > 0:
+                copy(self.backup_f, broken)
+                if self.wal_f is not None:
+                    copy(self.wal_f, broken)
+                self.durability.sync()
+
+        self._repair = Thread(target=repair)
+        self._repair.start()
+
+    def wait_repair(self):
+        """ Waits for the backups to be repaired, before they are used again. """
+        if self._repair is not None:
+            self._repair.join()
+            self._repair = None
+
+    def recover(self, just_check = False):
+        if self.backup_f is None:
+            raise Exception("No backup files available.")
+
+        self.wait_repair()
+        winner, data, stale = self.read_backups(self.backup_f, self.wal_f)
 
         if not just_check:
-            # Assign it
-            self.i, self.vi, self.N, self.all_seen, \
-                self.round, self.locks, self.decision = data
+            self.restore(data)
+            self.repair_backups(winner, stale)
         else:
             # Check it is equal
             all_ok = (self.i, self.vi, self.N, self.all_seen, \
@@ -110,10 +288,6 @@ class dls_state_machine():
                 print(data)
                 raise Exception("Backups are failing")
 
-        if errors:
-            # Since one or more of the backups were broken, we are now re-writing them.
-            pass # TODO
-
     def set_make_raw(self, maker):
         """ Set a function that packages the messages, with signatures, etc. """
         self.make_raw =  maker
@@ -126,19 +300,61 @@ class dls_state_machine():
         """ Returns the ever increasing phase number. """
         return xround // 4
 
+    def leader_locked(self, phase):
+        """ Returns whether the leader of a phase sent us a lock. """
+        leader = self.get_leader_phase(phase)
+        return any(m.sender == leader for m in self.buf_in.get(self.PHASE1LOCK, phase))
+
+    def get_first_round(self, phase):
+        """ Returns the first round of a phase. """
+        return phase * 4
+
     def get_leader(self, xround):
         """ Returns the leader for the phase. """
         return self.get_leader_phase( self.get_phase_k(xround) )
 
     def get_leader_phase(self, phase):
         """ Get the leader for a particular phase. """
+        if self.leaders is not None:
+            return self.leaders(phase)
         return phase % self.N        
 
     def get_round_type(self, xround):
         """ Returns the round type as where 0-2 are trying0-2 and 3 is lock-release. """
         return xround % 4
 
+    def round_complete(self):
+        """ Returns whether all the messages that the current round processes have arrived,
+        so that it may end early. Rounds that wait for nothing are never complete. """
+        k = self.get_phase_k(self.round)
+        rtype = self.get_round_type(self.round)
+        leader = self.get_leader(self.round) == self.i
+
+        if rtype == 1 and leader:
+            # The leader locks on the acceptable items of all peers.
+            return len(set(m.sender for m in self.buf_in.get(self.PHASE0, k))) >= self.N
+        elif rtype in (1, 2):
+            # All peers ack the lock of the leader, and need nothing else until then.
+            return self.leader_locked(k)
+        elif rtype == 3 and leader:
+            # The leader decides on the acks of all peers.
+            return len(set(m.sender for m in self.buf_in.get(self.PHASE2ACK, k))) >= self.N
+        return False
+
     def check_phase1msg(self, msg):
+        """ Checks a lock is valid, using the cache of locks already checked. """
+        # Signed locks are keyed by their signature, others by value.
+        key = getattr(msg.raw, "signature", None)
+        if key is None:
+            key = msg
+
+        valid = self.lock_cache.get(key)
+        if valid is None:
+            valid = self._check_phase1msg(msg)
+            self.lock_cache.put(key, valid)
+        return valid
+
+    def _check_phase1msg(self, msg):
 
         # Check the basic format.
         if not (msg.type == self.PHASE1LOCK):
@@ -149,7 +365,7 @@ class dls_state_machine():
             return False
 
         # Check all votes are valid.
-        votes = set()
+        votes = 0
         for e in msg.evidence:
             if not (e.type == self.PHASE0):
                 return False
@@ -157,10 +373,13 @@ class dls_state_machine():
             if not (e.phase == msg.phase and msg.item in e.acceptable):
                 return False
 
-            votes.add(e.sender)
+            if not (0 <= e.sender < self.N):
+                return False
+
+            votes |= 1 << e.sender
 
         # Check quorum
-        if not (len(votes) >= (self.N - self.faulty())):
+        if not (bitcount(votes) >= (self.N - self.faulty())):
             return False
 
         return True
@@ -172,7 +391,7 @@ class dls_state_machine():
         if len(self.locks) == 0:
             return tuple(self.all_seen)
         elif len(self.locks) == 1:
-            return ( self.locks.keys()[0], )
+            return ( list(self.locks)[0], )
         else:
             print (len(self.locks), self.locks)
             assert False
@@ -194,36 +413,23 @@ class dls_state_machine():
         if self.i == self.get_leader(self.round):
 
             k = self.get_phase_k(self.round)
-            evidence = {}
-
-            for msg in self.buf_in:
-                if msg.type == self.PHASE0 and msg.phase == k:
-                    for acc in msg.acceptable:
-                        if acc not in evidence:
-                            evidence[acc] = (set(), set())
-                        
-                        votes, evid_set = evidence[acc]
-                        votes |= set([ msg.sender ])
-                        evid_set |= set([ msg ])
-
-            # Prune those with enough evidence:
-            for acc in evidence.keys():
-                votes, _ = evidence[acc]
-                if len(votes) < self.N - self.faulty():
-                    del evidence[acc]
-
-            if len(evidence) > 0:
-                if self.vi in evidence:
+
+            # Keep only the items with enough evidence.
+            tally = self.buf_in.tally(self.PHASE0)
+            candidates = tally.quorums(k)
+
+            if len(candidates) > 0 and k not in self._lock_phases:
+                if self.vi in candidates:
                     # prefer our own.
                     item = self.vi
                 else:
                     # Chose arbitrarily.
-                    item = max(evidence)
+                    item = max(candidates)
 
-                votes, evid_set = evidence[item]
-                evidence = tuple(evid_set)
+                evidence = tuple(tally.evidence(k, item))
                 msg = PHASE1LOCK(self.PHASE1LOCK, item, k, evidence, self.i, None)
                 msg = self.make_raw(msg)
+                self._lock_phases.add(k)
                 self.buf_in.add(msg)
                 self.buf_out.add(msg)
 
@@ -231,9 +437,10 @@ class dls_state_machine():
 
     def process_trying_2(self):
         k = self.get_phase_k(self.round)
-        for msg in list(self.buf_in):
-            if msg.type == self.PHASE1LOCK and msg.phase == k and self.check_phase1msg(msg):
+        for msg in list(self.buf_in.get(self.PHASE1LOCK, k)):
+            if (k, msg.item) not in self._acked and self.check_phase1msg(msg):
                 item = msg.item
+                self._acked.add((k, item))
 
                 self.locks[item] = msg
 
@@ -259,42 +466,45 @@ class dls_state_machine():
 
     # Those can be run at all phases!
     def process_release_locks(self):
-        for msg in self.buf_in:
-            if msg.type == self.RELEASE3 and self.check_phase1msg(msg.evidence):
+        for msg in self.buf_in.of_type(self.RELEASE3):
+            if self.check_phase1msg(msg.evidence):
                 new_lock = msg.evidence
-                for old_lock in self.locks.values():
+                for old_lock in list(self.locks.values()):
                     if old_lock.item != new_lock.item and new_lock.phase >= old_lock.phase:
                         del self.locks[old_lock.item]
 
-    def process_acks(self):
-        all_acks = {}
-        for msg in self.buf_in:
-            # Only process acks for own phases
-            if msg.type == self.PHASE2ACK and self.get_leader_phase(msg.phase) == self.i:
-                if msg.item not in all_acks:
-                    all_acks[msg.item] = set()
-                all_acks[msg.item].add( msg.sender )
+    def on_quorum(self, mtype, phase, item):
+        """ Called by the inbound buffer as soon as an item gathers a quorum of votes. """
+        # Only process acks for own phases, unless all peers get all acks.
+        if mtype == self.PHASE2ACK and (self.eager or self.get_leader_phase(phase) == self.i):
+            self.decision = item
 
-                if len(all_acks[msg.item]) >= self.N - self.faulty():
-                    self.decision = msg.item
+    def process_eager(self):
+        """ Locks and acks for the current phase as soon as the messages are in, rather 
+        than on their rounds. """
+        rtype = self.get_round_type(self.round)
+        if rtype <= 1:
+            self.process_trying_1()
+        if rtype <= 2:
+            self.process_trying_2()
 
     def find_seen(self):
-        for msg in self.buf_in:
-            if msg.type == self.PHASE0:
-                self.all_seen |= set(msg.acceptable)
+        tally = self.buf_in.tally(self.PHASE0)
+        for phase in tally.phases:
+            for item in tally.items(phase):
+                if item not in self.all_seen:
+                    self.all_seen.add(item)
+                    self._new_seen.append(item)
 
     def clear_old_messages(self):
         k = self.get_phase_k(self.round)
-        for msg in list(self.buf_in):
-            if msg.phase < k:
-                self.buf_in.remove(msg)
+        self.buf_in.drop_before(k)
 
 
     def do_background(self):
         self.find_seen()
         self.process_release_locks()
         self.clear_old_messages()
-        self.process_acks()
 
     def process_round(self, advance=True, set_round=None):
         """ Run one round of the state machine. """
@@ -304,6 +514,8 @@ class dls_state_machine():
         self.do_background()
         rtype = self.get_round_type(self.round)
         process[rtype]()
+        if self.eager:
+            self.process_eager()
         
         if self._trace:
             r = self.round
@@ -318,6 +530,7 @@ class dls_state_machine():
                 print (l,v)
 
         # Always persist before processing messages.
+        self._restart_round = self.round
         self.persist()
 
         if advance:
@@ -338,7 +551,18 @@ class dls_state_machine():
         for m in msgs:
             assert 0 <= m.sender < self.N
 
-        self.buf_in |= set(msgs)
+        before = (len(self._lock_phases), len(self._acked), self.decision)
+
+        # Acks may reach a quorum, and so a decision, on arrival.
+        self.buf_in |= msgs
+
+        if self.eager:
+            self.process_eager()
+
+        # What is sent must be durable first, and the network peer sends decisions as
+        # soon as they are reached.
+        if before != (len(self._lock_phases), len(self._acked), self.decision):
+            self.persist()
 
         if self._trace:
             r = self.round
@@ -354,6 +578,9 @@ class dls_state_machine():
 
     def get_messages(self):
         """ Get all the messages emited by the state machine. """
+        # Messages are only released once the state that produced them is durable.
+        self.durability.barrier()
+
         msgs = self.buf_out.copy()
         self.buf_out.clear()
 
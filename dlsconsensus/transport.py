@@ -0,0 +1,132 @@
+""" Length prefixed frames over persistent TCP or Unix socket connections, for the
+driver of a peer and the host of many shards. Outbound frames are queued per
+destination, and written over one connection per destination, opened with its
+first frame and again after an error. Inbound frames are handed over as they
+are read.
+
+Endpoints are either a (host, port) pair for TCP, or a path for a Unix
+socket. """
+
+import asyncio
+import struct
+
+FRAME_HEADER = struct.Struct(">I")
+
+
+class dls_transport():
+    """ Sends and receives frames. Inbound frames go to receive(data), and the endpoint of
+    a destination is looked up with resolve(dest) when connecting to it. """
+
+    MAX_FRAME = 1 << 24
+    QUEUE_SIZE = 256
+
+    def __init__(self, receive, resolve=None):
+        self.receive = receive
+        self.resolve = resolve if resolve is not None else (lambda dest: dest)
+
+        self.server = None
+        self.queues = {}   # dest -> queue of frames
+        self.senders = {}  # dest -> task that writes the queue to the connection
+        self.tasks = set()
+        self.inbound = {} # task -> writer, of inbound connections
+
+        # Metrics
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped_frames = 0
+
+    async def listen(self, endpoint):
+        """ Starts listening, and returns the endpoint actually listened on. """
+        if isinstance(endpoint, str):
+            self.server = await asyncio.start_unix_server(self.serve, path=endpoint)
+            return endpoint
+
+        self.server = await asyncio.start_server(self.serve, *endpoint)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def serve(self, reader, writer):
+        """ Reads the frames from an inbound connection. """
+        task = asyncio.current_task()
+        self.inbound[task] = writer
+        try:
+            while True:
+                (size, ) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                if size > self.MAX_FRAME:
+                    self.dropped_frames += 1
+                    break
+                data = await reader.readexactly(size)
+                self.frames_in += 1
+                self.bytes_in += FRAME_HEADER.size + size
+                self.receive(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.inbound[task]
+            writer.close()
+
+    def send(self, dest, data):
+        """ Queues a frame for a destination. """
+        if dest not in self.queues:
+            self.queues[dest] = asyncio.Queue(self.QUEUE_SIZE)
+            self.senders[dest] = self.spawn(self.write(dest))
+        try:
+            self.queues[dest].put_nowait(FRAME_HEADER.pack(len(data)) + data)
+        except asyncio.QueueFull:
+            # The protocol resends what matters, so drop rather than block.
+            self.dropped_frames += 1
+
+    async def connect(self, dest):
+        endpoint = self.resolve(dest)
+        if isinstance(endpoint, str):
+            return await asyncio.open_unix_connection(endpoint)
+        return await asyncio.open_connection(*endpoint)
+
+    async def write(self, dest):
+        """ Writes the frames for a destination, over a persistent connection. """
+        queue = self.queues[dest]
+        writer = None
+        try:
+            while True:
+                frame = await queue.get()
+                try:
+                    if writer is None:
+                        _, writer = await self.connect(dest)
+                    writer.write(frame)
+                    await writer.drain()
+                    self.frames_out += 1
+                    self.bytes_out += len(frame)
+                except (OSError, KeyError):
+                    # Reconnect with the next frame.
+                    self.dropped_frames += 1
+                    if writer is not None:
+                        writer.close()
+                    writer = None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # Closing inbound connections ends their tasks, which are not cancelled.
+        serving = list(self.inbound)
+        for writer in list(self.inbound.values()):
+            writer.close()
+        await asyncio.gather(*serving, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def stats(self):
+        return { "frames_in": self.frames_in, "frames_out": self.frames_out,
+                 "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                 "dropped_frames": self.dropped_frames }
@@ -13,6 +13,26 @@ BLSACCEPTABLE = namedtuple("BLSACCEPTABLE", ["channel", "type", "sender", "bno",
 BLSLOCK       = namedtuple("BLSLOCK", ["channel", "type", "sender", "bno", "phase", "block", "evidence", "signature"])
 BLSACK        = namedtuple("BLSACK", ["channel", "type", "sender", "bno", "phase", "block", "signature"])
 
+# Asks peers for the evidence of a compact lock, by signature, or for block payloads,
+# by digest. Not signed.
+BLSFETCH      = namedtuple("BLSFETCH", ["channel", "type", "sender", "bno", "digests"])
+
+# Carries a block payload, addressed by its digest. Not signed, the digest is checked.
+BLSPAYLOAD    = namedtuple("BLSPAYLOAD", ["channel", "type", "sender", "digest", "block"])
+
+# A block entry, with the leaders that its proposer suspects to have failed.
+BLSHEALTH     = namedtuple("BLSHEALTH", ["type", "bno", "suspects"])
+
 # User facing actions. No authentication needed.
 BLSASK        = namedtuple("BLSASK", ["channel", "type", "sender", "bno"])
 BLSPUT        = namedtuple("BLSPUT", ["channel", "type", "sender", "item"])
+
+# Tells the sender of a BLSPUT that its item was refused, since the pool of pending items
+# is full, and how many items are pending.
+BLSBUSY       = namedtuple("BLSBUSY", ["channel", "type", "sender", "item", "depth"])
+
+# Asks for the decided blocks from bno on, and acknowledges those before it.
+BLSSUBSCRIBE  = namedtuple("BLSSUBSCRIBE", ["channel", "type", "sender", "bno"])
+
+# Decided blocks from bno on, each with the decisions of N-f peers on it.
+BLSBLOCKS     = namedtuple("BLSBLOCKS", ["channel", "type", "sender", "bno", "blocks", "certificates"])
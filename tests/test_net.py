@@ -1,10 +1,70 @@
 import sys
 sys.path = [".", ".."] + sys.path
 
-from dlsconsensus import dls_net_peer, BLSASK, BLSPUT, BLSDECISION, BLSACCEPTABLE, BLSLOCK, BLSACK
-from dlsconsensus import PHASE0
+from dlsconsensus import dls_net_peer, BLSASK, BLSPUT, BLSDECISION, BLSACCEPTABLE, BLSLOCK, BLSACK, BLSFETCH, BLSPAYLOAD, BLSHEALTH, BLSBUSY, BLSSUBSCRIBE
+from dlsconsensus import PHASE0, PHASE1LOCK
 from dlsconsensus import dls_state_machine as dlsc
 from dlsconsensus import pack, unpack
+from dlsconsensus.mempool import dls_mempool
+from dlsconsensus.persist import dls_durability
+from dlsconsensus.blockstore import dls_block_store
+from dlsconsensus.crypto import dls_hash_signer, dls_ed25519_signer
+from dlsconsensus.ingest import dls_ingest
+from dlsconsensus.codec import encode, decode, loads, frame, unframe
+from dlsconsensus.cache import dls_encoding_cache
+from dlsconsensus.driver import dls_driver, dls_pacemaker, dls_adaptive_pacemaker
+from dlsconsensus.leaders import dls_leader_schedule
+from dlsconsensus.host import dls_shard_host, dls_timer_wheel, shard_of
+from dlsconsensus.follower import dls_follower
+
+import os
+import random
+import tempfile
+
+ADDRS = ["A", "B", "C", "D"]
+PUBS = ["pubA", "pubB", "pubC", "pubD"]
+
+def make_committee(per_peer=None, **peer_kwargs):
+    """ Returns the peers of a committee by address, built with peer_kwargs, and the
+    kwargs per_peer(i) returns for peer i. """
+    kwargs = dict(priv="priv", pubs=PUBS, channel_id="Shard0", start_r=10)
+    kwargs.update(peer_kwargs)
+    peer = {}
+    for i, a in enumerate(ADDRS):
+        args = dict(kwargs, **(per_peer(i) if per_peer is not None else {}))
+        peer[a] = dls_net_peer(my_id=i, addrs=ADDRS, **args)
+    return peer
+
+def run_committee(peer, live=ADDRS, blocks=10, rounds=200, items=True, send=None, exchange=None):
+    """ Runs the peers of a committee in lock step until the live ones commit 'blocks' 
+    blocks, and checks that they commit the item each of them was given. Messages to
+    the live peers go through send(dest, msg), by default delivered after a round trip
+    through msgpack, unless exchange(p, r) replaces the exchange of peer p in round r.
+    Returns the number of rounds. """
+    if send is None:
+        send = lambda dest, msg: peer[dest].put_messages([ unpack(pack(msg)) ])
+    if exchange is None:
+        def exchange(p, r):
+            for (dest, msg) in peer[p].get_messages():
+                if dest in live:
+                    send(dest, msg)
+
+    if items:
+        for p in live:
+            peer[p].put_sequence("M%s" % p)
+
+    for r in range(rounds):
+        for p in live:
+            peer[p].advance_round()
+            exchange(p, r)
+        if min(peer[p].current_block_no for p in live) >= blocks:
+            break
+
+    assert set([peer[p].current_block_no for p in live]) == set([blocks])
+    if items:
+        for p in live:
+            assert set( peer[p].get_sequence() ) == set("M%s" % q for q in live)
+    return r
 
 def test_init():
     peer =  dls_net_peer(my_id=0, priv="priv", addrs=["A", "B", "C", "D"], 
@@ -55,6 +115,21 @@ def test_put():
     peer.put_messages([put_msg])
     assert peer.seq.to_be_sequenced == { 7, 8 }
 
+def test_put_busy():
+    peer =  dls_net_peer(my_id=0, priv="priv", addrs=["A", "B", "C", "D"], 
+                         pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0", 
+                         start_r=10, mempool=dls_mempool(capacity=2))
+
+    puts = [ BLSPUT(channel="Shard0", type=peer.BLSPUT, sender="Client1", item=i) for i in range(3) ]
+    peer.put_messages(puts)
+    assert peer.seq.to_be_sequenced == { 0, 1 }
+
+    # The sender of the refused item is told to back off.
+    assert peer.get_messages() == [ ("Client1", BLSBUSY("Shard0", "BLSBUSY", "A", 2, 2)) ]
+    assert unpack(pack(BLSBUSY("Shard0", "BLSBUSY", "A", 2, 2))) == BLSBUSY("Shard0", "BLSBUSY", "A", 2, 2)
+    assert not peer.put_sequence(3)
+    assert peer.seq.to_be_sequenced.stats()["rejected"] == 2
+
 def test_decision():
     peer =  dls_net_peer(my_id=0, priv="priv", addrs=["A", "B", "C", "D"], 
                          pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0", 
@@ -114,6 +189,24 @@ def test_acceptable():
     assert len(buf_in) == 1
     assert set(m.type for m in buf_in) == set([ sm.PHASE0 ])
 
+def test_acceptable_merge():
+    addrs = ["A", "B", "C", "D"]
+    peer, peerB = [ dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=["pubA","pubB","pubC","pubD"],
+                                 channel_id="Shard0", start_r=10) for i in range(2) ]
+    k = peer.sm.get_phase_k(peer.round)
+
+    # Items of proposals with a bad signature are not scheduled.
+    bad = BLSACCEPTABLE("Shard0", "BLSACCEPTABLE", "B", 0, k, ((7, 8),), b"forged")
+    peer.put_messages([ bad ])
+    assert peer.seq.to_be_sequenced == set()
+
+    # A proposal is merged once, however many phases it is sent in.
+    for phase in range(k, k + 3):
+        acc = peerB.pack_and_sign(BLSACCEPTABLE("Shard0", "BLSACCEPTABLE", "B", 0, phase, ((7, 8),), None))
+        peer.put_messages([ acc ])
+    assert peer.seq.to_be_sequenced == { 7, 8 }
+    assert peer.skipped_merges == 2
+
 
 def test_lock():
     peer =  dls_net_peer(my_id=0, priv="priv", addrs=["A", "B", "C", "D"], 
@@ -190,68 +283,834 @@ def test_ack():
     assert set(m.type for m in buf_in) == set([ sm.PHASE2ACK ])
 
 def test_many():
+    peer = make_committee()
+
+    def exchange(p, r):
+        msgs = peer[p].get_messages()
+        assert len(peer[p].output) == 0
+        for (dest, msg) in msgs:
+            peer[dest].put_messages([ msg ])
 
+    r = run_committee(peer, items=False, exchange=exchange)
+    print("\nRounds: %s" % r)
+
+def test_many_load():
+    r = run_committee(make_committee())
+    print("\nRounds: %s" % r)
+
+def test_block_store():
+    path = tempfile.mkdtemp()
+    store = dls_block_store(path, segment_size=100)
+    for bno in range(10):
+        store.append(bno, ("item%s" % bno, bno), [ "cert%s" % bno ])
+    store.close()
+
+    store = dls_block_store(path, segment_size=100)
+    assert len(store) == 10
+    assert store.get(3) == (("item3", 3), ("cert3", ))
+    store.append(10, ("item10",), [])
+    assert store.get_block(10) == ("item10",)
+
+def test_block_store_durable():
+    class recorder(dls_durability):
+        def __init__(self):
+            dls_durability.__init__(self, fsync=True)
+            self.log = []
+        def write(self, files, op):
+            self.log += [ ("write", os.path.basename(f1.name)) for f1 in files ]
+            dls_durability.write(self, files, op)
+        def _sync_one(self, f1):
+            self.log += [ ("sync", os.path.basename(f1.name)) ]
+            dls_durability._sync_one(self, f1)
+
+    # The record is synced before the index entry that makes it visible is written.
+    policy = recorder()
+    store = dls_block_store(tempfile.mkdtemp(), durability=policy)
+    store.append(0, ("item0",), [ "cert0" ])
+    assert policy.log == [ ("write", "segment-00000000.log"), ("sync", "segment-00000000.log"),
+                           ("write", "index") ]
+    policy.barrier()
+    assert policy.log[-1] == ("sync", "index") and len(policy.dirty) == 0
+    store.close()
+
+def test_item_index():
+    from dlsconsensus.net import dls_sequence
+
+    path = tempfile.mkdtemp()
+    store = dls_block_store(path)
+    seq = dls_sequence(store)
+    for bno in range(60):
+        block = [ "item%s" % i for i in range(bno * 20, bno * 20 + 30) ]
+        store.append(bno, block, [])
+        seq.set_block(bno, block)
+
+    # The table grew past its initial capacity, and repeated items count once.
+    assert store.items.capacity > store.items.CAPACITY
+    assert seq.length == 1210 and "item0" in seq.sequence and "item1210" not in seq.sequence
+    assert store.items.get("item25") == (0, 25) and store.items.get("item45") == (1, 25)
+    assert list(seq.get_sequence(1200)) == [ "item%s" % i for i in range(1200, 1210) ]
+
+    # A block stored but not indexed before a crash is indexed at restart.
+    store.append(60, [ "item1209", "extra" ], [])
+    store.close()
+    store = dls_block_store(path)
+    assert store.items.blocks == 60
+    seq = dls_sequence(store, window=2)
+    assert store.items.blocks == 61 and seq.length == 1211
+    assert store.items.get("extra") == (60, 1) and store.items.get("item1209") == (59, 29)
+    assert list(seq.get_sequence(1209)) == [ "item1209", "extra" ]
+
+def test_many_store():
+    paths = [ tempfile.mkdtemp() for _ in range(4) ]
+    peer = make_committee(lambda i: dict(store=dls_block_store(paths[i])), window=2)
+    run_committee(peer)
+
+    for px in peer.values():
+        assert len(px.store) == 10
+        assert len(px.seq.old_blocks) == 2
+        assert all(bno >= 10 - 2 for bno in px.decisions)
+
+    # Old blocks are served from the store.
+    px = peer["A"]
+    px.put_messages([ BLSASK(channel="Shard0", type=px.BLSASK, sender="Client1", bno=1) ])
+    out = [ msg for (_, msg) in px.get_messages() if msg.bno == 1 ]
+    assert len(out) >= 3
+    assert len(set(msg.block for msg in out)) == 1
+
+    # A restarted peer picks up from the store.
+    sequence = list(px.get_sequence())
+    px.store.close()
+    restarted = dls_net_peer(my_id=0, priv="priv", addrs=ADDRS, pubs=PUBS, channel_id="Shard0", 
+                             start_r=10, store=dls_block_store(paths[0]), window=2)
+    assert restarted.current_block_no == 10
+    assert list(restarted.get_sequence()) == sequence
+
+    # It serves the decisions saved with the blocks in its window, and signs no other.
+    block = restarted.store.get_block(9)
+    assert restarted.has_quorum(9) == block
+    restarted.put_messages([ BLSASK(channel="Shard0", type=px.BLSASK, sender="Client1", bno=9) ])
+    out = [ msg for (_, msg) in restarted.get_messages() if msg.bno == 9 ]
+    assert len(out) >= 3 and all(msg.block == block and restarted.verify(msg) for msg in out)
+    assert len(restarted.certificate(9)) >= 3
+    assert all(d.block == block for d in restarted.certificate(9))
+
+    # Items committed in blocks left in the store are not scheduled again.
+    assert restarted.put_sequence("MA")
+    assert "MA" not in restarted.seq.to_be_sequenced
+
+def test_commit_receipts():
+    paths = [ tempfile.mkdtemp() for _ in range(4) ]
     peer = {}
     addrs=["A", "B", "C", "D"]
     for i in range(4):
         peer[addrs[i]] =  dls_net_peer(my_id=i, priv="priv", addrs=addrs, 
                              pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0", 
-                             start_r=10)
-
-    for r in range(200):
-        peer["C"].sm._trace = False
+                             start_r=10, store=dls_block_store(paths[i]), window=2)
 
+    for r in range(400):
         for p in addrs:
+            peer[p].put_sequence("M%s-%s" % (p, r // 20))
             peer[p].advance_round()
-            msgs = peer[p].get_messages()
-            assert len(peer[p].output) == 0
-
-            for (dest, msg) in msgs:
+            for (dest, msg) in peer[p].get_messages():
                 peer[dest].put_messages([ msg ])
 
-        if set([peer[p].current_block_no for p in addrs]) == set([10]):       
+        if min(peer[p].current_block_no for p in addrs) >= 8:
             break
 
-    assert set([peer[p].current_block_no for p in addrs]) == set([10])
-    print("")
-    #print([(peer[p].current_block_no, peer[p].seq.old_blocks) for p in addrs])
-    print("Rounds: %s" % r)
+    px = peer["A"]
+    sequence = px.get_sequence()
+    assert len(sequence) > 4
+    for offset in [0, 1, len(sequence) // 2, len(sequence) - 1, len(sequence)]:
+        assert list(px.iter_sequence(offset)) == sequence[offset:]
 
+    # Committed items are found with their block, and N-f decisions on it, also
+    # for blocks only held in the store.
+    for item in [ sequence[0], sequence[-1] ]:
+        bno, pos, cert = px.get_commit(item)
+        block = px.store.get_block(bno)
+        assert block[pos] == item
+        assert len(cert) >= 3
+        assert all(d.bno == bno and d.block == block and px.verify(d) for d in cert)
+    assert px.is_archived(px.get_commit(sequence[0])[0])
+    assert px.get_commit("Unknown") is None
 
-import random
+    # The index is rebuilt from the store.
+    where = px.get_commit(sequence[0])[:2]
+    px.store.close()
+    restarted = dls_net_peer(my_id=0, priv="priv", addrs=addrs, 
+                             pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0", 
+                             start_r=10, store=dls_block_store(paths[0]), window=2)
+    assert restarted.get_commit(sequence[0])[:2] == where
+    assert list(restarted.iter_sequence(3)) == sequence[3:]
 
-def test_many_load():
+def test_duplicates_dropped():
+    peer =  dls_net_peer(my_id=0, priv="priv", addrs=["A", "B", "C", "D"], 
+                         pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0", 
+                         start_r=10)
+    peerB =  dls_net_peer(my_id=1, priv="priv", addrs=["A", "B", "C", "D"], 
+                         pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0", 
+                         start_r=10)
+    k = peer.sm.get_phase_k(peer.round)
+
+    ack_msg = peerB.pack_and_sign(BLSACK(channel="Shard0", type=peer.BLSACK, sender="B", 
+                     bno=0, phase=k, block=(7,8), signature=None))
+    peer.put_messages([ack_msg, ack_msg])
+    peer.put_messages([ack_msg])
+    assert peer.dropped_duplicates == 2
+    assert len(peer.sm.buf_in) == 1
+
+    # A forged message reusing a valid signature is not taken from the cache.
+    forged = ack_msg._replace(block=(9,))
+    peer.put_messages([forged])
+    assert len(peer.sm.buf_in) == 1
+
+    # Decisions are re-fed every round, and only verified once.
+    decision_msg = peerB.pack_and_sign(BLSDECISION(channel="Shard0", type=peer.BLSDECISION, 
+                     sender="B", bno=0, block=(7,8), signature=None))
+    misses = peer.verified.misses
+    for _ in range(5):
+        peer.put_messages([decision_msg])
+    assert len(peer.verified) == 2
+    assert peer.verified.misses == misses
+
+def test_batch_verification():
+    from concurrent.futures import ThreadPoolExecutor
+
+    signer = dls_hash_signer(executor=ThreadPoolExecutor(2))
+    items = [ (None, ("data%s" % i).encode(), signer.sign(None, ("data%s" % i).encode())) for i in range(200) ]
+    items[7] = (None, b"data7", "bad")
+    res = signer.verify_batch(items)
+    assert len(res) == 200 and res.count(False) == 1 and not res[7]
+
+def test_ed25519_peers():
+    import pytest
+    pytest.importorskip("cryptography")
+
+    keys = [ dls_ed25519_signer.generate_keys() for _ in range(4) ]
+    peer = make_committee(lambda i: dict(priv=keys[i][0], signer=dls_ed25519_signer()),
+                          pubs=[ pub for (_, pub) in keys ])
+    run_committee(peer)
+
+    # A message signed with the wrong key is rejected.
+    k = peer["A"].sm.get_phase_k(peer["A"].round)
+    ack = BLSACK(channel="Shard0", type="BLSACK", sender="B", bno=10, phase=k, block=(7,), signature=None)
+    forged = peer["C"].pack_and_sign(ack._replace(sender="C"))._replace(sender="B")
+    assert not peer["A"].check_sign(forged)
+
+def test_many_ingest():
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(2)
+    peer = make_committee()
+    ingest = dict((p, dls_ingest(peer[p], executor)) for p in ADDRS)
+
+    # Messages reach each peer through its ingest stage, before its next round.
+    def send(dest, msg):
+        ingest[dest].submit([ pack(msg) ])
+        ingest[dest].drain(wait=True)
+
+    run_committee(peer, send=send)
+
+    # Broken and forged messages are dropped before the peer sees them.
+    px = ingest["A"]
+    px.drain(wait=True)
+    dropped = px.dropped_invalid
+    k = peer["A"].sm.get_phase_k(peer["A"].round)
+    ack = peer["B"].pack_and_sign(BLSACK(channel="Shard0", type="BLSACK", sender="B", bno=10, 
+                                         phase=k, block=(7,), signature=None))
+    px.submit([ b"\xc1", pack(ack._replace(block=(8,))), pack(ack) ])
+    assert px.ready(wait=True) == [ ack ]
+    assert px.dropped_invalid == dropped + 2
+
+    # Envelopes carry messages in either format.
+    px.submit_envelope(frame([ encode(ack), pack(ack) ]))
+    assert px.ready(wait=True) == [ ack, ack ]
+    assert px.dropped_invalid == dropped + 2
+
+def test_codec_roundtrip():
+    peerB =  dls_net_peer(my_id=1, priv="priv", addrs=["A", "B", "C", "D"], 
+                         pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0")
+    acc = peerB.pack_and_sign(BLSACCEPTABLE(channel="Shard0", type=peerB.BLSACCEPTABLE, 
+                     sender="B", bno=2, phase=3, blocks=((7, "x", b"y", -300, 2**40, None, True),), 
+                     signature=None))
+    lock = peerB.pack_and_sign(BLSLOCK(channel="Shard0", type=peerB.BLSLOCK, sender="B", 
+                     bno=2, phase=3, block=(7,), evidence=(acc, acc), signature=None))
+    odd_put = BLSPUT(channel="Shard0", type=peerB.BLSASK, sender="Client1", item=7)
+    sm_msg = PHASE0(dlsc.PHASE0, ((1, 2),), 3, 1, acc)
 
+    for msg in [ acc, lock, odd_put, sm_msg, [ 1.5, set([1, 2]), {"a": (1, )}, -2**40 ] ]:
+        assert decode(encode(msg)) == msg
+        assert type(decode(encode(msg))) == type(msg)
+
+        # Both formats are understood.
+        assert loads(encode(msg)) == msg
+        assert loads(pack(msg)) == msg
+
+    assert len(encode(lock)) < len(pack(lock))
+
+def test_encode_once():
     peer = {}
     addrs=["A", "B", "C", "D"]
     for i in range(4):
         peer[addrs[i]] =  dls_net_peer(my_id=i, priv="priv", addrs=addrs, 
                              pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0", 
-                             start_r=10)
+                             start_r=15)
 
-    for p in addrs:
-        peer[p].put_sequence("M%s" % p)
+    # Peer A leads the next phase, and sends its PHASE0 message to all others.
+    px = peer["A"]
+    px.advance_round()
+    px.advance_round()
+    assert px.i_am_leader()
+    out = px.get_encoded_messages()
+    assert len(out) == 3
+    assert len(set(data for (_, data) in out)) == 1
+    assert len(px.encodings.wire) == 1
+    msg = loads(out[0][1])
+    assert msg.sender == "A"
 
-    for r in range(200):
-        peer["C"].sm._trace = False
+    # Signing and checking the signature serialize the message once, and so does sending.
+    assert px.encodings.signed.misses == 1
+    assert out[0][1] == pack(msg)
 
-        for p in addrs:
+    # With the codec on the wire, the wire bytes are the signed bytes and the signature.
+    encodings = dls_encoding_cache(dumps=encode)
+    data = encodings.encode(msg)
+    assert data.startswith(encodings.signed_data(msg)) and data == encode(msg)
+    assert loads(data) == msg and encodings.signed.misses == 1
+
+def test_many_compact_evidence():
+    peer = make_committee(compact_evidence=True)
+    locks = []
+
+    def send(dest, msg):
+        if type(msg) == BLSLOCK:
+            locks.append(msg)
+        peer[dest].put_messages([ unpack(pack(msg)) ])
+
+    run_committee(peer, send=send)
+
+    # Locks only carry signatures.
+    assert len(locks) > 0
+    assert all(type(e) == str for lock in locks for e in lock.evidence)
+
+def test_compact_lock_fetch():
+    addrs = ["A", "B", "C", "D"]
+    peers = [ dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=["pubA","pubB","pubC","pubD"], 
+                           channel_id="Shard0", start_r=10, compact_evidence=True) for i in range(4) ]
+    peer, leader = peers[0], peers[2]
+    k = peer.sm.get_phase_k(peer.round)
+
+    ev = tuple( p.package_raw(PHASE0(dlsc.PHASE0, ("hello0",), k, p.i, None)) for p in peers[1:] )
+    lock = leader.package_raw(PHASE1LOCK(dlsc.PHASE1LOCK, "hello0", k, ev, 2, None))
+    assert all(type(e) == str for e in lock.raw.evidence)
+
+    # The lock waits for its evidence, which is asked from the leader.
+    peer.put_messages([ lock.raw ])
+    assert len(peer.sm.buf_in) == 0
+    fetches = [ (dest, m) for (dest, m) in peer.get_messages() if type(m) == BLSFETCH ]
+    assert len(fetches) == 1 and fetches[0][0] == "C"
+
+    leader.put_messages([ fetches[0][1] ])
+    replies = [ (dest, m) for (dest, m) in leader.get_messages() if dest == "A" ]
+    assert len(replies) == 3
+
+    peer.put_messages([ m for (_, m) in replies ])
+    assert set(m.type for m in peer.sm.buf_in) == set([ dlsc.PHASE0, dlsc.PHASE1LOCK, dlsc.RELEASE3 ])
+
+def test_compact_lock_pending_bounded():
+    addrs = ["A", "B", "C", "D"]
+    peer, leader = [ dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=["pubA","pubB","pubC","pubD"],
+                                  channel_id="Shard0", start_r=10, compact_evidence=True) for i in (0, 2) ]
+    peer.pending_locks.size = 4
+
+    # A faulty leader sends locks whose evidence nobody holds: only one per phase waits,
+    # and only the latest phases are kept.
+    def lock(k, j):
+        return leader.pack_and_sign(BLSLOCK("Shard0", leader.BLSLOCK, "C", 0, k, "hello%s" % j,
+                                            ("missing%s-%s" % (k, j), ), None))
+    peer.put_messages([ lock(k, j) for k in range(10) for j in range(3) ])
+    assert len(peer.pending_locks) == 4
+    assert [ key for key, _ in peer.pending_locks.items() ] == [ ("C", 0, k) for k in range(6, 10) ]
+    fetches = [ m for (_, m) in peer.get_messages() if type(m) == BLSFETCH ]
+    assert len(fetches) == 10
+
+    # Their evidence is asked from all for a few rounds only.
+    sent = 0
+    for _ in range(10):
+        peer.advance_round()
+        sent += len([ m for (_, m) in peer.get_messages() if type(m) == BLSFETCH ])
+    assert sent == 4 * peer.LOCK_FETCHES * 3
+
+def test_fetch_checked():
+    peer = dls_net_peer(my_id=0, priv="priv", addrs=["A", "B", "C", "D"],
+                        pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0")
+    d = peer.seq.put_payload(("M",))
+
+    # Fetches without a tuple of digests are dropped, and the rest of the batch served.
+    bad = [ BLSFETCH("Shard0", "BLSFETCH", "B", 0, digests) for digests in (5, ([1],), (d, {}), [d]) ]
+    peer.put_messages(bad + [ BLSFETCH("Shard0", "BLSFETCH", "C", 0, (d,)) ])
+    assert [ (dest, type(m)) for dest, m in peer.get_messages() ] == [ ("C", BLSPAYLOAD) ]
+
+def test_many_payload_digests():
+    peer = make_committee(payload_digests=True)
+    sent = []
+
+    def send(dest, msg):
+        sent.append((dest, msg))
+        peer[dest].put_messages([ unpack(pack(msg)) ])
+
+    run_committee(peer, send=send)
+
+    # Consensus messages only carry digests, and each payload is pushed once per peer.
+    assert all(type(m.block) == str for (_, m) in sent if type(m) in (BLSLOCK, BLSACK, BLSDECISION))
+    pushes = [ (m.sender, dest, m.digest) for (dest, m) in sent if type(m) == BLSPAYLOAD ]
+    assert len(pushes) > 0 and len(pushes) == len(set(pushes))
+
+def test_payload_pull():
+    addrs = ["A", "B", "C", "D"]
+    peers = [ dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=["pubA","pubB","pubC","pubD"], 
+                           channel_id="Shard0", payload_digests=True) for i in range(4) ]
+    block = ("hello0", "hello1")
+    d = peers[1].seq.put_payload(block)
+
+    # A decision for an unknown digest makes the peer ask the sender for the payload.
+    dec = peers[1].pack_and_sign(BLSDECISION("Shard0", "BLSDECISION", "B", 0, d, None))
+    peers[0].put_messages([ dec ])
+    fetches = [ (dest, m) for (dest, m) in peers[0].get_messages() if type(m) == BLSFETCH ]
+    assert fetches == [ ("B", BLSFETCH("Shard0", "BLSFETCH", "A", 0, (d, ))) ]
+
+    peers[1].put_messages([ fetches[0][1] ])
+    replies = peers[1].get_messages()
+    assert replies == [ ("A", BLSPAYLOAD("Shard0", "BLSPAYLOAD", "B", d, block)) ]
+
+    # Payloads that do not match their digest are ignored.
+    peers[0].put_messages([ BLSPAYLOAD("Shard0", "BLSPAYLOAD", "B", d, ("forged", )) ])
+    assert peers[0].seq.get_payload(d) is None
+
+    peers[0].put_messages([ unpack(pack(replies[0][1])) ])
+    assert peers[0].seq.get_payload(d) == block
+    assert peers[0].seq.to_be_sequenced == set(block)
+
+def test_frame_roundtrip():
+    datas = [ encode((1, 2)), pack("x"), b"", b"y" * 300 ]
+    for compress in [ False, True ]:
+        env = frame(datas, compress)
+        assert unframe(env) == datas
+        assert unframe(frame([], compress)) == []
+
+    for broken in [ b"", pack("x"), frame(datas)[:-1], frame(datas) + b"z", frame(datas, True)[:-1],
+                    frame(datas)[:3] ]:
+        try:
+            unframe(broken)
+            assert False
+        except ValueError:
+            pass
+
+def test_decode_broken():
+    assert decode(encode((1, -2, "x", b"y", None))) == (1, -2, "x", b"y", None)
+
+    # Negative or too large sizes, reads past the end, unknown message ids, bad text,
+    # and unhashable set items are all rejected with a ValueError.
+    for broken in [ b"\xc1\x01\x06\x05", b"\xc1\x01\x06\x7f", b"\xc1\x01\x0b\xff", 
+                    b"\xc1\x01\x0b", b"\xc1\x01\x03\x80", b"\xc1\x01\x04\x02\xff",
+                    b"\xc1\x01\x08\x02\x07\x00", b"\xc1\x01\x0a\x00", b"\xc1\x01\x0c",
+                    encode(("x", 2))[:-1], encode(BLSASK("S", "BLSASK", "C", 1))[:-1] ]:
+        try:
+            decode(broken)
+            assert False, broken
+        except ValueError:
+            pass
+
+def test_many_envelopes():
+    peer = make_committee()
+
+    def exchange(p, r):
+        envelopes = peer[p].get_envelopes(compress=(r % 2 == 0))
+
+        # One envelope per destination.
+        dests = [ dest for (dest, _) in envelopes ]
+        assert len(dests) == len(set(dests))
+        for (dest, env) in envelopes:
+            peer[dest].put_envelope(env)
+
+    run_committee(peer, exchange=exchange)
+
+def run_drivers(listen, pacemaker=lambda: dls_pacemaker(0.005), **kwargs):
+    import asyncio
+
+    addrs=["A", "B", "C", "D"]
+    endpoints = {}
+    drivers = [ dls_driver(dls_net_peer(my_id=i, priv="priv", addrs=addrs, 
+                                        pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0"),
+                           endpoints, pacemaker(), **kwargs) for i in range(4) ]
+
+    async def main():
+        for i, d in enumerate(drivers):
+            await d.start(listen(i))
+        for i, d in enumerate(drivers):
+            d.submit("M%s" % addrs[i])
+
+        for _ in range(1000):
+            if all(set(["MA", "MB", "MC", "MD"]) <= d.peer.seq.sequence for d in drivers):
+                break
+            await asyncio.sleep(0.01)
+
+        for d in drivers:
+            await d.stop()
+
+    asyncio.run(main())
+    return drivers
+
+def test_driver_tcp():
+    drivers = run_drivers(lambda i: ("127.0.0.1", 0))
+
+    for d in drivers:
+        assert d.peer.current_block_no >= 1
+        assert set(["MA", "MB", "MC", "MD"]) <= set(d.peer.get_sequence())
+
+        stats = d.stats()
+        assert stats["committed"] >= 4 and stats["throughput"] > 0
+        assert stats["commit_latency"] > 0 and stats["frames_in"] > 0
+
+def test_driver_unix(tmp_path):
+    drivers = run_drivers(lambda i: str(tmp_path / ("peer%s.sock" % i)), compress=True)
+
+    for d in drivers:
+        assert d.peer.current_block_no >= 1
+        assert set(["MA", "MB", "MC", "MD"]) <= set(d.peer.get_sequence())
+
+def test_adaptive_pacemaker():
+    pm = dls_adaptive_pacemaker(round_time=0.1, min_time=0.001, max_time=1.0, margin=2.0, grace=1)
+    assert pm.timeout(1) == 0.1
+
+    # Rounds shrink to a margin over the time their messages take.
+    for _ in range(20):
+        pm.observe(1, 0.01)
+    assert abs(pm.timeout(1) - 0.02) < 1e-6
+    assert pm.timeout(0) == 0.1
+
+    # And back off exponentially after phases without a decision, up to a limit.
+    pm.end_phase(False)
+    assert abs(pm.timeout(1) - 0.02) < 1e-6
+    pm.end_phase(False)
+    pm.end_phase(False)
+    assert abs(pm.timeout(1) - 0.08) < 1e-6
+    for _ in range(20):
+        pm.end_phase(False)
+    assert pm.timeout(1) == 1.0
+
+    pm.end_phase(True)
+    assert abs(pm.timeout(1) - 0.02) < 1e-6
+
+def test_driver_adaptive():
+    drivers = run_drivers(lambda i: ("127.0.0.1", 0), 
+                          pacemaker=lambda: dls_adaptive_pacemaker(round_time=0.02))
+
+    for d in drivers:
+        assert set(["MA", "MB", "MC", "MD"]) <= set(d.peer.get_sequence())
+        assert d.stats()["early_rounds"] > 0
+        assert any(e is not None for e in d.pacemaker.estimates)
+
+def test_sync_round():
+    addrs = ["A", "B", "C", "D"]
+    peers = [ dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=["pubA","pubB","pubC","pubD"], 
+                           channel_id="Shard0") for i in range(4) ]
+    acc = [ p.pack_and_sign(BLSACCEPTABLE("Shard0", "BLSACCEPTABLE", p.my_addr(), 0, 10, ((),), None))
+            for p in peers[1:] ]
+
+    # A single, possibly faulty, peer cannot make others skip rounds.
+    peers[0].put_messages(acc[:1])
+    assert peers[0].sync_round() is None
+
+    peers[0].put_messages(acc[1:2])
+    assert peers[0].sync_round() == 40
+    peers[0].advance_round(set_round=40)
+    assert peers[0].sync_round() is None
+
+def test_many_eager():
+    # Blocks take fewer rounds when locks, acks and decisions happen on arrival.
+    assert run_committee(make_committee(eager=True)) < run_committee(make_committee(eager=False))
+
+def test_leader_schedule():
+    s = dls_leader_schedule(4)
+    assert [ s.leader(k) for k in range(8) ] == [0, 1, 2, 3, 0, 1, 2, 3]
+
+    # A leader is only suspected after failing in a row, and at most f are.
+    s.observe(3, False)
+    assert s.health_entry(5).suspects == ()
+    s.observe(3, False)
+    s.observe(2, False)
+    s.observe(2, False)
+    s.observe(2, False)
+    entry = s.health_entry(5)
+    assert entry == BLSHEALTH("BLSHEALTH", 5, (2,))
+
+    # Only valid entries for the block set the schedule.
+    s.apply(5, [ BLSHEALTH("BLSHEALTH", 5, (0, 1)), "M1", entry ])
+    assert s.suspects == (2,)
+    assert s.leader(2) != 2 and s.leader(6) == 2
+    assert sorted(s.leader(k) for k in range(8)) == [0, 0, 1, 1, 2, 3, 3, 3]
+
+    s.apply(6, [ "M2" ])
+    assert s.suspects == ()
+
+    # With a lag, the schedule of a block is set by the block lag before it, and stays.
+    s = dls_leader_schedule(4, lag=2)
+    s.apply(5, [ entry ])
+    leaders = s.leaders(7)
+    assert [ leaders(k) for k in range(8) ] == [ s.leader(k, (2,)) for k in range(8) ]
+    assert [ s.leaders(6)(k) for k in range(4) ] == [0, 1, 2, 3]
+    s.apply(6, [ "M2" ])
+    assert leaders(2) != 2 and s.leaders(7)(2) != 2 and s.leaders(8)(2) == 2
+
+def test_many_leader_health():
+    # D has crashed, and fewer phases are wasted on it as a leader.
+    run = lambda leader_health: run_committee(make_committee(leader_health=leader_health),
+                                              live=["A", "B", "C"], rounds=500)
+    assert run(True) < run(False)
+
+def test_many_pipeline():
+    def run(pipeline):
+        peer = make_committee(pipeline=pipeline)
+
+        def exchange(p, r):
+            for (dest, msg) in peer[p].get_messages():
+                peer[dest].put_messages([ unpack(pack(msg)) ])
+            peer[p].put_sequence("M%s-%s" % (p, r))
+
+        r = run_committee(peer, blocks=12, items=False, exchange=exchange)
+
+        # All peers commit the same blocks, and no item twice.
+        blocks = min(peer[p].current_block_no for p in ADDRS)
+        for p in ADDRS:
+            assert peer[p].seq.old_blocks[:blocks] == peer["A"].seq.old_blocks[:blocks]
+            seq = peer[p].get_sequence()
+            assert len(seq) == len(set(seq))
+        return r
+
+    # Blocks are decided concurrently.
+    assert run(3) < run(None)
+
+def test_many_pipeline_leader_health():
+    addrs = ["A", "B", "C", "D"]
+    live = ["A", "B", "C"]
+    files = { p: [ [ tempfile.TemporaryFile() for _ in range(2) ] for _ in range(3) ] for p in addrs }
+    peer = {}
+    for i in range(4):
+        peer[addrs[i]] = dls_net_peer(my_id=i, priv="priv", addrs=addrs,
+                             pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0",
+                             start_r=10, pipeline=3, leader_health=True, backup_f=files[addrs[i]])
+
+    # D has crashed, and some messages are lost, so peers commit at different rounds.
+    for r in range(600):
+        for p in live:
+            peer[p].put_sequence("M%s-%s" % (p, r // 20))
             peer[p].advance_round()
-            msgs = peer[p].get_messages()
-            assert len(peer[p].output) == 0
+            for n, (dest, msg) in enumerate(peer[p].get_messages()):
+                if dest in live and (r + n) % 7 != 0:
+                    peer[dest].put_messages([ unpack(pack(msg)) ])
 
-            for (dest, msg) in msgs:
-                # assert msg.signature != None
-                m = pack(msg)
-                m2 = unpack(m)
-                peer[dest].put_messages([ m2 ])
+        # Peers agree on the leaders of each block in progress, whatever they committed.
+        for bno in set(bno for p in live for bno, _ in peer[p].state_machines()):
+            schedules = set(tuple(sm.get_leader_phase(k) for k in range(16))
+                            for p in live for b, sm in peer[p].state_machines() if b == bno)
+            assert len(schedules) == 1
 
-        if set([peer[p].current_block_no for p in addrs]) == set([10]):       
+        if min(peer[p].current_block_no for p in live) >= 10:
             break
 
-    out = [(peer[p].current_block_no, peer[p].seq.old_blocks) for p in addrs]
-    assert set([peer[p].current_block_no for p in addrs]) == set([10])
-    print("\nRounds: %s" % r)
+    assert min(peer[p].current_block_no for p in live) >= 10
+    assert any(len(peer[p].leaders.suspects) > 0 for p in live)
+    blocks = min(peer[p].current_block_no for p in live)
+    for p in live:
+        assert peer[p].seq.old_blocks[:blocks] == peer["A"].seq.old_blocks[:blocks]
 
-    for px in peer.values():
-        assert set( px.get_sequence() ) == set(["MA", "MB", "MC", "MD"])
+    # Each block in progress persists to the backups of its own slot.
+    px = peer["A"]
+    for bno, sm in px.state_machines():
+        assert sm.backup_f is files["A"][bno % 3]
+        assert dlsc.recover_from_f(sm.backup_f[0])[-2] == sm.locks
+
+def test_pipeline_receivers():
+    addrs = ["A", "B", "C", "D"]
+    px = dls_net_peer(my_id=3, priv="priv", addrs=addrs, pubs=["pubA","pubB","pubC","pubD"],
+                      channel_id="Shard0", pipeline=2, leader_health=True)
+
+    # Block 1 follows a schedule that suspects A, and block 0 the default one.
+    px.leaders.apply(-1, [ BLSHEALTH("BLSHEALTH", -1, (0,)) ])
+    px.ahead[1] = px.new_state_machine(("M",), 1)
+    assert px.sm.get_leader(px.round) == 0 and px.ahead[1].get_leader(px.round) == 1
+
+    px.advance_round()
+    assert sorted((dest, msg.bno) for dest, msg in px.get_messages()) == [ ("A", 0), ("B", 1) ]
+
+def test_timer_wheel():
+    wheel = dls_timer_wheel(tick=0.01, slots=8, now=0.0)
+    wheel.schedule("A", 0.05, 0.0)
+    wheel.schedule("B", 0.5, 0.0) # More than a turn of the wheel away.
+    wheel.schedule("C", 0.02, 0.0)
+    wheel.cancel("C")
+    assert len(wheel) == 2
+
+    assert wheel.advance(0.04) == []
+    assert wheel.advance(0.05) == ["A"]
+    assert wheel.advance(0.2) == []
+    wheel.schedule("B", 0.01, 0.2) # Replaces the earlier timer.
+    assert wheel.advance(0.21) == ["B"]
+    assert len(wheel) == 0
+
+def test_shard_host():
+    import asyncio
+
+    addrs = ["A", "B", "C", "D"]
+    channels = [ "Shard%s" % c for c in range(6) ]
+    workers = 2
+    assert set(shard_of(c, workers) for c in channels) == set([0, 1])
+
+    # Each peer address is a host of two worker processes, here run in one loop.
+    endpoints = {}
+    hosts = {}
+    for a in addrs:
+        for w in range(workers):
+            hosts[a, w] = dls_shard_host(endpoints, tick=0.001, workers=workers, worker=w)
+    for c in channels:
+        for i, a in enumerate(addrs):
+            peer = dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=["pubA","pubB","pubC","pubD"],
+                                channel_id=c)
+            hosts[a, shard_of(c, workers)].add_peer(peer, dls_pacemaker(0.02))
+            peer.put_sequence("%s-%s" % (c, a))
+
+    async def main():
+        for a in addrs:
+            endpoints[a] = [ await hosts[a, w].start(("127.0.0.1", 0)) for w in range(workers) ]
+
+        def done():
+            return all(set("%s-%s" % (c, a) for a in addrs) <= s.peer.seq.sequence
+                       for h in hosts.values() for c, s in h.shards.items())
+        for _ in range(1000):
+            if done():
+                break
+            await asyncio.sleep(0.01)
+
+        for h in hosts.values():
+            await h.stop()
+
+    asyncio.run(main())
+
+    for h in hosts.values():
+        for c, s in h.shards.items():
+            assert set("%s-%s" % (c, a) for a in addrs) <= set(s.peer.get_sequence())
+        stats = h.stats()
+        assert stats["blocks"] >= stats["shards"] and stats["dropped_messages"] == 0
+        # One connection per destination, shared by all shards.
+        assert stats["connections"] <= len(addrs)
+
+def test_mempool():
+    pool = dls_mempool(max_items=3)
+    for i in [5, 1, 4, 2, 3]:
+        assert pool.add(i)
+    assert pool == set([1, 2, 3, 4, 5])
+
+    # Blocks take the items in arrival order, up to the block size.
+    assert pool.take() == (5, 1, 4)
+    assert pool.take(exclude={ 5: 0 }) == (1, 4, 2)
+    pool.remove_all((5, 1))
+    assert pool.take() == (4, 2, 3) and len(pool) == 3
+
+    # Or by priority, and within a size in bytes.
+    pool = dls_mempool(max_bytes=len(pack(1)) * 2, priority=lambda i: -i)
+    for i in [5, 1, 4, 2, 3]:
+        pool.add(i)
+    assert pool.take() == (5, 4)
+    pool.remove_all((5, 4))
+    assert pool.take(limit=1) == (3, )
+
+    stats = pool.stats()
+    assert stats["depth"] == 3 and stats["max_depth"] == 5 and stats["removed"] == 2
+    assert stats["mean_wait"] >= 0
+
+def test_many_mempool():
+    peer = {}
+    addrs=["A", "B", "C", "D"]
+    for i in range(4):
+        peer[addrs[i]] =  dls_net_peer(my_id=i, priv="priv", addrs=addrs,
+                             pubs=["pubA","pubB","pubC","pubD"], channel_id="Shard0",
+                             start_r=10, mempool=dls_mempool(max_items=5))
+
+    items = [ "M%s" % i for i in range(40) ]
+    for m in items:
+        peer["A"].put_sequence(m)
+
+    for r in range(400):
+        for p in addrs:
+            peer[p].advance_round()
+            for (dest, msg) in peer[p].get_messages():
+                peer[dest].put_messages([ unpack(pack(msg)) ])
+
+        if all(set(items) <= set(peer[p].get_sequence()) for p in addrs):
+            break
+
+    # A backlog is spread over blocks of bounded size, in arrival order.
+    for p in addrs:
+        assert peer[p].get_sequence() == items
+        assert max(len(b) for b in peer[p].seq.old_blocks) <= 5
+        assert len(peer[p].seq.to_be_sequenced) == 0
+
+def test_subscribe():
+    peer = {}
+    addrs=["A", "B", "C", "D"]
+    pubs = ["pubA","pubB","pubC","pubD"]
+    for i in range(4):
+        peer[addrs[i]] =  dls_net_peer(my_id=i, priv="priv", addrs=addrs, pubs=pubs,
+                                       channel_id="Shard0", start_r=10)
+    px = peer["A"]
+    px.SUBSCRIBE_CREDIT = 4
+    px.SUBSCRIBE_BATCH = 3
+
+    def run(blocks):
+        for r in range(400):
+            for p in addrs:
+                peer[p].put_sequence("M%s-%s" % (p, r // 8))
+                peer[p].advance_round()
+                for (dest, msg) in peer[p].get_messages():
+                    if dest == "Client1":
+                        client_out.append(msg)
+                    else:
+                        peer[dest].put_messages([ unpack(pack(msg)) ])
+            if min(peer[p].current_block_no for p in addrs) >= blocks:
+                break
+
+    client_out = []
+    run(6)
+
+    # Catching up, the subscriber gets as many blocks as its credit, in batches.
+    follower = dls_follower("Client1", addrs, pubs, "Shard0")
+    px.put_messages([ unpack(pack(follower.get_subscribe())) ])
+    out = [ msg for (dest, msg) in px.get_messages() if dest == "Client1" ]
+    assert [ (m.bno, len(m.blocks)) for m in out ] == [ (0, 3), (3, 1) ]
+    for m in out:
+        follower.put_blocks(unpack(pack(m)))
+    assert [ bno for bno, _ in follower.get_blocks() ] == [0, 1, 2, 3]
+
+    # Blocks with a bad certificate, or already received, are not taken.
+    forged = out[1]._replace(bno=4)
+    assert follower.put_blocks(forged) == 0 and follower.rejected == 1
+    assert follower.put_blocks(out[0]) == 0 and follower.next_bno == 4
+
+    # Acknowledged blocks let more through, and new blocks are pushed as committed.
+    px.put_messages([ follower.get_subscribe() ])
+    client_out += [ msg for (dest, msg) in px.get_messages() if dest == "Client1" ]
+    run(px.current_block_no + 3)
+    for m in client_out:
+        follower.put_blocks(unpack(pack(m)))
+        px.put_messages([ follower.get_subscribe() ])
+        client_out += [ msg for (dest, msg) in px.get_messages() if dest == "Client1" ]
+
+    blocks = follower.get_blocks()
+    assert [ bno for bno, _ in blocks ] == list(range(4, px.current_block_no))
+    assert [ b for _, b in blocks ] == [ px.seq.get_block(bno) for bno, _ in blocks ]
+
+    # Subscriptions from a bad bno on are ignored, and the rest of the batch goes through.
+    bad = [ BLSSUBSCRIBE("Shard0", "BLSSUBSCRIBE", "Client2", bno) for bno in (-3, "0", None, 1.5) ]
+    px.put_messages(bad + [ BLSSUBSCRIBE("Shard0", "BLSSUBSCRIBE", "Client3", 0) ])
+    assert set(dest for dest, _ in px.get_messages()) == set([ "Client3" ])
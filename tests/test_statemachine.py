@@ -227,3 +227,284 @@ def test_f_persist():
 
     assert set([nx.decision for nx in nodes[:3]]) == set(["Hello1"])
     assert set([nx.decision for nx in nodes]) == set(["Hello1", None])
+
+from dlsconsensus.buffer import dls_buffer
+
+def test_buffer_index():
+    buf = dls_buffer()
+    buf |= set([ PHASE0(dlsc.PHASE0, ("hello0", "hello1"), 0, 0, None),
+                 PHASE0(dlsc.PHASE0, ("hello0",), 0, 1, None),
+                 PHASE0(dlsc.PHASE0, ("hello0",), 1, 2, None),
+                 PHASE2ACK(dlsc.PHASE2ACK, "hello0", 1, 2, None) ])
+
+    # Duplicates are ignored.
+    assert not buf.add( PHASE0(dlsc.PHASE0, ("hello0",), 0, 1, None) )
+    assert len(buf) == 4
+
+    assert len(buf.get(dlsc.PHASE0, 0)) == 2
+    tally = buf.tally(dlsc.PHASE0)
+    assert tally.senders(0, "hello0") == set([0, 1])
+    assert len(tally.evidence(0, "hello0")) == 2
+    assert tally.senders(0, "hello1") == set([0])
+    assert buf.tally(dlsc.PHASE2ACK).count(1, "hello0") == 1
+
+    # Old phases are dropped at once.
+    buf.drop_before(1)
+    assert len(buf) == 2
+    assert len(buf.tally(dlsc.PHASE0).items(0)) == 0
+    assert set(m.type for m in buf) == set([ dlsc.PHASE0, dlsc.PHASE2ACK ])
+
+from dlsconsensus.quorum import dls_tally
+
+def test_tally_quorum_callback():
+    fired = []
+    tally = dls_tally(threshold=3, on_quorum=lambda phase, item: fired.append((phase, item)))
+
+    assert not tally.vote(0, "hello0", 0)
+    assert not tally.vote(0, "hello0", 0)
+    assert not tally.vote(0, "hello0", 100)
+    assert fired == []
+    assert tally.vote(0, "hello0", 2)
+    assert fired == [(0, "hello0")]
+
+    # Further votes do not fire again.
+    assert not tally.vote(0, "hello0", 3)
+    assert fired == [(0, "hello0")]
+    assert tally.count(0, "hello0") == 4
+    assert tally.senders(0, "hello0") == set([0, 2, 3, 100])
+    assert tally.quorums(0) == ["hello0"]
+
+def test_decision_on_ack_arrival():
+    dls = dls_state_machine(my_vi="Hello", my_id=0, N=4)
+    acks = [ PHASE2ACK(dlsc.PHASE2ACK, "hello0", 0, i, None) for i in range(3) ]
+
+    dls.put_messages(acks[:2])
+    assert dls.get_decision() is None
+    dls.put_messages(acks[2:])
+    assert dls.get_decision() == "hello0"
+
+def test_decision_persisted_on_arrival():
+    files = [tempfile.SpooledTemporaryFile(10000) for _ in range(2)]
+    dls = dls_state_machine(my_vi="Hello", my_id=0, N=4, backup_f=files)
+    acks = [ PHASE2ACK(dlsc.PHASE2ACK, "hello0", 0, i, None) for i in range(3) ]
+
+    # The decision is durable before any round runs, since it may be sent at once.
+    dls.put_messages(acks)
+    dls.durability.barrier()
+    assert dls_state_machine.recover_from_f(files[0])[-1] == "hello0"
+
+def test_lock_check_cached():
+    evidence = tuple( PHASE0(dlsc.PHASE0, ("hello0",), 0, i, None) for i in range(3) )
+    lock = PHASE1LOCK(dlsc.PHASE1LOCK, "hello0", 0, evidence, 0, None)
+    bad_lock = PHASE1LOCK(dlsc.PHASE1LOCK, "hello0", 0, evidence[:2], 0, None)
+
+    dls = dls_state_machine(my_vi="Hello", my_id=1, N=4)
+    assert dls.check_phase1msg(lock)
+    assert not dls.check_phase1msg(bad_lock)
+    assert dls.lock_cache.misses == 2
+
+    for _ in range(5):
+        assert dls.check_phase1msg(lock)
+        assert not dls.check_phase1msg(bad_lock)
+    assert dls.lock_cache.hits == 10
+
+def test_f_persist_wal():
+    N = 4
+    nodes = []
+
+    node_files = []
+    wal_files = []
+    for _ in range(N):
+        node_files.append([tempfile.SpooledTemporaryFile(10000) for _ in range(3)])
+        wal_files.append([tempfile.SpooledTemporaryFile(10000) for _ in range(3)])
+
+    for i in range(N):
+        dls = dls_state_machine(my_vi="Hello%s" % i, my_id=i, N=4, 
+                                backup_f=node_files[i], wal_f=wal_files[i])
+        dls.WAL_COMPACT_EVERY = 5
+        dls.persist()
+        nodes += [ dls ]
+
+    for r in range(50):
+
+        if r % 11 == 0:
+            nodes = []
+            for i in range(N):
+                dls = dls_state_machine.from_recovery(backup_f=node_files[i], wal_f=wal_files[i])
+                dls.WAL_COMPACT_EVERY = 5
+                nodes += [ dls ]
+
+        all_messages = set()
+        for n in nodes:
+            n.process_round()
+            if n.i < n.N - n.faulty():
+                all_messages |= n.get_messages()
+
+            # The logs and snapshot always recover the current state.
+            rec = dls_state_machine.from_recovery(backup_f=node_files[n.i], wal_f=wal_files[n.i])
+            assert (rec.all_seen, rec.locks, rec.decision) == (n.all_seen, n.locks, n.decision)
+            assert rec.round == n.round - 1
+
+        for n in nodes:
+            n.put_messages(all_messages)
+
+    assert set([nx.decision for nx in nodes[:3]]) == set(["Hello1"])
+    assert set([nx.decision for nx in nodes]) == set(["Hello1", None])
+
+def test_wal_stale_records():
+    files = [tempfile.SpooledTemporaryFile(10000) for _ in range(2)]
+    wals = [tempfile.SpooledTemporaryFile(10000) for _ in range(2)]
+    evidence = lambda v: tuple( PHASE0(dlsc.PHASE0, (v,), 0, i, None) for i in range(3) )
+    lock_a = PHASE1LOCK(dlsc.PHASE1LOCK, "A", 0, evidence("A"), 0, None)
+    lock_b = PHASE1LOCK(dlsc.PHASE1LOCK, "B", 4, evidence("B"), 0, None)
+
+    dls = dls_state_machine(my_vi="Hello", my_id=1, N=4, backup_f=files, wal_f=wals)
+    dls.persist()
+    dls.process_round()
+    dls.locks = { "A": lock_a }
+    dls.persist()
+    logs = []
+    for f1 in wals:
+        f1.seek(0)
+        logs += [ f1.read() ]
+
+    # A crash after the snapshot is durable, but before the logs are emptied.
+    dls.process_round()
+    dls.locks = { "B": lock_b }
+    dls.decision = "B"
+    dls.persist_snapshot()
+    for f1, raw in zip(wals, logs):
+        f1.seek(0)
+        f1.write(raw)
+
+    rec = dls_state_machine.from_recovery(backup_f=files, wal_f=wals)
+    assert (rec.round, rec.locks, rec.decision) == (1, { "B": lock_b }, "B")
+
+    # Records written after the snapshot are replayed.
+    dls.locks["C"] = lock_a
+    dls.persist()
+    rec = dls_state_machine.from_recovery(backup_f=files, wal_f=wals)
+    assert rec.locks == { "B": lock_b, "C": lock_a }
+
+def test_wal_torn_record():
+    from dlsconsensus.persist import wal_append, wal_records
+
+    f1 = tempfile.SpooledTemporaryFile(10000)
+    wal_append(f1, b"first")
+    wal_append(f1, b"second")
+    f1.seek(-3, 2)
+    f1.truncate()
+
+    assert list(wal_records(f1)) == [ b"first" ]
+
+from dlsconsensus.persist import dls_durability
+
+def test_group_commit():
+    # Two state machines share a policy that only syncs before messages go out.
+    policy = dls_durability(sync_every=None, workers=2)
+    files = [[tempfile.TemporaryFile() for _ in range(3)] for _ in range(2)]
+    nodes = [ dls_state_machine(my_vi="Hello%s" % i, my_id=i, N=4, backup_f=files[i], 
+                                durability=policy) for i in range(2) ]
+
+    for n in nodes:
+        n.process_round()
+    assert len(policy.dirty) == 6
+    assert policy.syncs == 0
+
+    # The first to release messages syncs the files of both.
+    assert len(nodes[0].get_messages()) == 1
+    assert policy.syncs == 1 and policy.synced_files == 6
+    assert len(nodes[1].get_messages()) == 1
+    assert policy.syncs == 1
+
+def test_sync_batches():
+    policy = dls_durability(fsync=True, sync_every=3)
+    dls = dls_state_machine(my_vi="Hello", my_id=0, N=4, 
+                            backup_f=[tempfile.TemporaryFile() for _ in range(2)], durability=policy)
+    for _ in range(6):
+        dls.persist()
+    assert policy.syncs == 2
+    dls.persist()
+    assert len(policy.dirty) == 2
+
+def test_recover_repairs_backups():
+    files = [tempfile.SpooledTemporaryFile(10000) for _ in range(3)]
+    dls = dls_state_machine(my_vi="Hello", my_id=5, N=7, backup_f=files)
+    dls.persist()
+    for _ in range(3):
+        dls.process_round()
+
+    # Leave an older backup behind, and break another one.
+    files[1].seek(0)
+    old = files[1].read()
+    dls.process_round()
+    files[1].seek(0)
+    files[1].write(old)
+    files[1].truncate()
+    files[0].seek(30)
+    files[0].write(b"XXXX")
+
+    rec = dls_state_machine.from_recovery(backup_f=files)
+    assert (rec.i, rec.N, rec.round) == (5, 7, 3)
+    assert rec.faulty() == 2
+
+    rec.wait_repair()
+    files[2].seek(0)
+    latest = files[2].read()
+    for f1 in files:
+        f1.seek(0)
+        assert f1.read() == latest
+
+def test_round_complete():
+    # Node 0 leads phase 0.
+    leader = dls_state_machine(my_vi="Hello0", my_id=0, N=4)
+    other = dls_state_machine(my_vi="Hello1", my_id=1, N=4)
+    p0s = [ PHASE0(dlsc.PHASE0, ("Hello0",), 0, i, None) for i in range(4) ]
+
+    # Sending the acceptable items waits for nothing.
+    assert not leader.round_complete()
+    leader.process_round()
+
+    # The leader waits for the acceptable items of all peers.
+    leader.put_messages(p0s[1:3])
+    assert not leader.round_complete()
+    leader.put_messages(p0s[3:])
+    assert leader.round_complete()
+    leader.process_round()
+
+    # The leader has its own lock, other peers wait for it.
+    assert leader.round_complete()
+    other.process_round()
+    other.process_round()
+    assert not other.round_complete()
+    other.put_messages(leader.buf_out)
+    assert other.round_complete()
+
+def test_eager_lock_ack_decide():
+    # Node 0 leads phase 0, and locks as soon as a quorum of acceptable items is in.
+    nodes = [ dls_state_machine(my_vi="Hello%s" % i, my_id=i, N=4, eager=True) for i in range(4) ]
+    p0s = [ PHASE0(dlsc.PHASE0, ("Hello0",), 0, i, None) for i in range(1, 4) ]
+
+    nodes[0].put_messages(p0s[:2])
+    assert len(nodes[0].buf_out) == 0
+    nodes[0].put_messages(p0s[2:])
+    out = nodes[0].get_messages()
+    [ lock ] = [ m for m in out if m.type == dlsc.PHASE1LOCK ]
+    assert lock.item == "Hello0"
+
+    # The leader acks its own lock at once.
+    assert set(m.type for m in out) == set([ dlsc.PHASE1LOCK, dlsc.PHASE2ACK ])
+
+    # A later round does not lock again.
+    nodes[0].process_round()
+    assert not any(m.type == dlsc.PHASE1LOCK for m in nodes[0].get_messages())
+
+    # Peers ack the lock on arrival, and any of them decides on a quorum of acks.
+    acks = set()
+    for n in nodes[1:]:
+        n.put_messages([ lock ])
+        acks |= n.get_messages()
+    assert set(m.type for m in acks) == set([ dlsc.PHASE2ACK ]) and len(acks) == 3
+
+    nodes[1].put_messages(acks)
+    assert nodes[1].get_decision() == "Hello0"